@@ -0,0 +1,1257 @@
+# Data layer shared by the Streamlit app (main14_deploy.py) and the Telegram bot: storage
+# backends, table schemas, the blob store, the user index, exports and the registration engine
+import pandas as pd
+import openpyxl
+import os
+import ast
+import collections
+import contextlib
+import csv
+import functools
+import hashlib
+import json
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime
+from io import BytesIO
+
+try:
+    import fcntl
+except ImportError:  # Windows: locks are only held within this process
+    fcntl = None
+
+# Directory for data files
+DATA_DIR = 'data'
+if not os.path.exists(DATA_DIR):
+    os.makedirs(DATA_DIR)
+
+# File paths
+USER_DATA_FILE = os.path.join(DATA_DIR, 'users.csv')
+EVENT_DATA_FILE = os.path.join(DATA_DIR, 'events.csv')
+REGISTRATION_DATA_FILE = os.path.join(DATA_DIR, 'registrations.csv')
+MESSAGES_DATA_FILE = os.path.join(DATA_DIR, 'messages.csv')
+FILES_DATA_FILE = os.path.join(DATA_DIR, 'files.csv')
+CONTACT_DATA_FILE = os.path.join(DATA_DIR, 'contact_data.csv')
+
+# Roster and event exports, generated when an admin asks for one
+EXPORT_DIR = os.path.join(DATA_DIR, 'exports')
+
+# Uploaded files, stored once under their SHA-256
+BLOB_DIR = os.path.join(DATA_DIR, 'blobs')
+BLOB_CHUNK_SIZE = 1024 * 1024
+
+# Table columns and the columns that get an index in the SQLite backend
+TABLE_COLUMNS = {
+    USER_DATA_FILE: ['ID', 'Name', 'Last Name', 'Mobile Number', 'Telegram ID', 'Username', 'Password'],
+    EVENT_DATA_FILE: ['EventID', 'Event Name', 'Date', 'Time', 'Day', 'Location', 'Description', 'Max Volunteers', 'Reserve Capacity'],
+    REGISTRATION_DATA_FILE: ['UserID', 'EventID', 'Status', 'Joined At'],
+    MESSAGES_DATA_FILE: ['UserID', 'Message', 'Response'],
+    FILES_DATA_FILE: ['UserID', 'Filename', 'Hash', 'Size', 'FromAdmin'],
+    CONTACT_DATA_FILE: ['MessageID', 'UserID', 'Subject', 'Message', 'Response', 'Sent At', 'Status'],
+}
+TABLE_INDEXES = {
+    USER_DATA_FILE: ['ID', 'Username'],
+    EVENT_DATA_FILE: ['EventID'],
+    REGISTRATION_DATA_FILE: ['UserID', 'EventID'],
+    MESSAGES_DATA_FILE: ['UserID'],
+    FILES_DATA_FILE: ['UserID'],
+    CONTACT_DATA_FILE: ['MessageID', 'UserID', 'Status'],
+}
+# Case-insensitive (COLLATE NOCASE) indexes, which serve prefix searches (LIKE 'text%')
+TABLE_SEARCH_INDEXES = {
+    USER_DATA_FILE: ['Name', 'Last Name', 'Username', 'Telegram ID'],
+}
+# Column types applied on load; other columns stay strings
+STATUS_DTYPE = pd.CategoricalDtype(['Registered', 'Reserve'])
+MESSAGE_STATUS_DTYPE = pd.CategoricalDtype(['unread', 'answered'])
+DAY_DTYPE = pd.CategoricalDtype(['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'])
+TABLE_SCHEMAS = {
+    USER_DATA_FILE: {'ID': 'int'},
+    EVENT_DATA_FILE: {'EventID': 'int', 'Date': 'datetime', 'Time': 'time', 'Day': DAY_DTYPE, 'Max Volunteers': 'int', 'Reserve Capacity': 'int'},
+    REGISTRATION_DATA_FILE: {'UserID': 'int', 'EventID': 'int', 'Status': STATUS_DTYPE, 'Joined At': 'datetime'},
+    MESSAGES_DATA_FILE: {'UserID': 'int'},
+    FILES_DATA_FILE: {'UserID': 'int', 'Size': 'int', 'FromAdmin': 'bool'},
+    CONTACT_DATA_FILE: {'MessageID': 'int', 'UserID': 'int', 'Sent At': 'datetime', 'Status': MESSAGE_STATUS_DTYPE},
+}
+# Tables whose rows get IDs from a persistent sequence
+TABLE_ID_COLUMNS = {
+    USER_DATA_FILE: 'ID',
+    EVENT_DATA_FILE: 'EventID',
+    CONTACT_DATA_FILE: 'MessageID',
+}
+
+# Ensure files exist
+for file, columns in TABLE_COLUMNS.items():
+    if not os.path.exists(file):
+        pd.DataFrame(columns=columns).to_csv(file, index=False)
+
+# Storage backend: 'csv' (default), 'sqlite' or 'feather'
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'csv')
+SQLITE_DB_FILE = os.environ.get('SQLITE_DB_FILE', os.path.join(DATA_DIR, 'events.db'))
+FEATHER_SUFFIX = '.feather'
+
+# Last ID handed out per table by the CSV backend
+SEQUENCE_FILE = os.path.join(DATA_DIR, 'sequences.json')
+
+# Journal of inserts/updates/deletes that have not been folded into the CSV yet
+JOURNAL_SUFFIX = '.journal'
+# Compact once the journal has this many entries, or earlier on big tables: when entries x rows
+# passes COMPACT_WORK_THRESHOLD
+COMPACT_THRESHOLD = 500
+COMPACT_WORK_THRESHOLD = 10_000_000
+
+
+# CSV files with an append-only journal for inserts, updates and deletes
+class CsvStorage:
+    indexed = False
+    columnar = False
+
+    def load(self, file):
+        data, entries = self.read(file)
+        rows = len(data)
+        data = prepare_table(file, apply_journal(data, entries))
+        # Periodic compaction: reads already pay for the whole table, writes never do
+        if len(entries) >= COMPACT_THRESHOLD or len(entries) * rows >= COMPACT_WORK_THRESHOLD:
+            self.compact(file)
+        return data
+
+    # Consistent snapshot of the CSV and its journal; retried if a compaction replaced the CSV meanwhile
+    def read(self, file):
+        while True:
+            with open(file, encoding='utf-8') as f:
+                inode = os.fstat(f.fileno()).st_ino
+                data = pd.read_csv(f, dtype='str')
+            entries = self.read_journal(file)
+            if os.stat(file).st_ino == inode:
+                return data, entries
+
+    # Writers hold the table lock so compaction never drops a concurrent insert
+    def save(self, file, data):
+        with file_lock(file):
+            self.write(file, data)
+
+    def compact(self, file):
+        with file_lock(file):
+            data, entries = self.read(file)
+            self.write(file, apply_journal(data, entries))
+
+    def write(self, file, data):
+        tmp_file = file + '.tmp'
+        data.to_csv(tmp_file, index=False)
+        os.replace(tmp_file, file)
+        if os.path.exists(journal_path(file)):
+            os.remove(journal_path(file))
+
+    def append(self, file, rows):
+        with file_lock(file):
+            with open(file, encoding='utf-8') as f:
+                header = next(csv.reader([f.readline()]), [])
+            if self.journal_size(file) == 0 and all(set(row) <= set(header) for row in rows):
+                with open(file, 'a', newline='', encoding='utf-8') as f:
+                    writer = csv.DictWriter(f, fieldnames=header, lineterminator='\n')
+                    writer.writerows(rows)
+            else:
+                self.write_journal(file, [{'op': 'insert', 'row': row} for row in rows])
+
+    def update(self, file, where, changes):
+        with file_lock(file):
+            self.write_journal(file, [{'op': 'update', 'where': where, 'set': changes}])
+
+    def delete(self, file, where):
+        with file_lock(file):
+            self.write_journal(file, [{'op': 'delete', 'where': where}])
+
+    def version(self, file):
+        version = []
+        for path in (file, journal_path(file)):
+            try:
+                stat = os.stat(path)
+                version += [stat.st_ino, stat.st_mtime_ns, stat.st_size]
+            except OSError:
+                version += [0, 0, 0]
+        return tuple(version)
+
+    def next_id(self, file, column):
+        table = table_name(file)
+        with file_lock(SEQUENCE_FILE):
+            sequences = {}
+            if os.path.exists(SEQUENCE_FILE):
+                with open(SEQUENCE_FILE, encoding='utf-8') as f:
+                    sequences = json.load(f)
+            if table not in sequences:
+                # Seed from the highest ID already in the table, once
+                ids = pd.to_numeric(self.load(file)[column], errors='coerce')
+                sequences[table] = int(ids.max()) if ids.notna().any() else 0
+            sequences[table] += 1
+            tmp_file = SEQUENCE_FILE + '.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(sequences, f)
+            os.replace(tmp_file, SEQUENCE_FILE)
+        return sequences[table]
+
+    # Add columns introduced by newer versions of the app to an existing CSV
+    def upgrade(self, file, columns):
+        with open(file, encoding='utf-8') as f:
+            header = next(csv.reader([f.readline()]), [])
+        if all(column in header for column in columns):
+            return
+        with file_lock(file):
+            data, entries = self.read(file)
+            data = apply_journal(data, entries)
+            for column in columns:
+                if column not in data.columns:
+                    data[column] = None
+            self.write(file, data)
+
+    def journal_size(self, file):
+        try:
+            return os.path.getsize(journal_path(file))
+        except OSError:
+            return 0
+
+    def write_journal(self, file, entries):
+        with open(journal_path(file), 'a', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+
+    def read_journal(self, file):
+        if self.journal_size(file) == 0:
+            return []
+        with open(journal_path(file), encoding='utf-8') as f:
+            # A line without its newline is still being written
+            return [json.loads(line) for line in f if line.endswith('\n') and line.strip()]
+
+
+# Embedded SQLite database with one table per CSV and indexes from TABLE_INDEXES
+class SqliteStorage:
+    indexed = True
+    columnar = False
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.local = threading.local()
+        # Several app processes may start at once; only one creates and imports the tables
+        with file_lock(db_file):
+            self.create_tables()
+
+    def create_tables(self):
+        conn = self.connect()
+        conn.execute('PRAGMA journal_mode=WAL')
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS table_versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS sequences (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+        for file, columns in TABLE_COLUMNS.items():
+            table = table_name(file)
+            exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone()
+            with conn:
+                conn.execute(f'CREATE TABLE IF NOT EXISTS "{table}" ({", ".join(f"{quote(c)} TEXT" for c in columns)})')
+                # Indexed columns may be newer than the table
+                self.add_columns(conn, table, columns)
+                indexes = {f'idx_{table}_{column}': quote(column) for column in TABLE_INDEXES[file]}
+                indexes.update({f'idx_{table}_{column}_nocase': f'{quote(column)} COLLATE NOCASE' for column in TABLE_SEARCH_INDEXES.get(file, [])})
+                for name, expression in indexes.items():
+                    conn.execute(f'CREATE INDEX IF NOT EXISTS {quote(name)} ON "{table}" ({expression})')
+                # Drop indexes earlier versions created that are no longer used
+                for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name=? AND name LIKE 'idx\\_%' ESCAPE '\\'", (table,)).fetchall():
+                    if name not in indexes:
+                        conn.execute(f'DROP INDEX {quote(name)}')
+            # Import the existing CSV the first time the table is created
+            if not exists and os.path.exists(file):
+                self.save(file, CsvStorage().load(file))
+
+    def connect(self):
+        # One connection per thread; Streamlit runs each session in its own thread
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=30, check_same_thread=False)
+            self.local.conn = conn
+        return conn
+
+    def columns(self, conn, table):
+        return [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]
+
+    def add_columns(self, conn, table, columns):
+        existing = self.columns(conn, table)
+        for column in columns:
+            if column not in existing:
+                conn.execute(f'ALTER TABLE "{table}" ADD COLUMN {quote(column)} TEXT')
+                existing.append(column)
+
+    def upgrade(self, file, columns):
+        conn = self.connect()
+        table = table_name(file)
+        if all(column in self.columns(conn, table) for column in columns):
+            return
+        with conn:
+            self.add_columns(conn, table, columns)
+            self.bump_version(conn, table)
+
+    def query(self, file, sql='', params=()):
+        conn = self.connect()
+        table = table_name(file)
+        cursor = conn.execute(f'SELECT * FROM "{table}" {sql}', params)
+        data = pd.DataFrame(cursor.fetchall(), columns=[d[0] for d in cursor.description], dtype='str')
+        return prepare_table(file, data)
+
+    def load(self, file):
+        return self.query(file, 'ORDER BY rowid')
+
+    def save(self, file, data):
+        conn = self.connect()
+        table = table_name(file)
+        with conn:
+            self.add_columns(conn, table, data.columns)
+            conn.execute(f'DELETE FROM "{table}"')
+            self.insert(conn, table, [{c: to_cell(v) for c, v in row.items()} for row in data.to_dict('records')])
+            self.bump_version(conn, table)
+
+    def append(self, file, rows):
+        conn = self.connect()
+        table = table_name(file)
+        with conn:
+            self.add_columns(conn, table, {column for row in rows for column in row})
+            self.insert(conn, table, rows)
+            self.bump_version(conn, table)
+
+    def insert(self, conn, table, rows):
+        for row in rows:
+            columns = list(row)
+            conn.execute(
+                f'INSERT INTO "{table}" ({", ".join(quote(c) for c in columns)}) VALUES ({", ".join("?" for _ in columns)})',
+                [row[c] for c in columns]
+            )
+
+    def update(self, file, where, changes):
+        conn = self.connect()
+        table = table_name(file)
+        condition, params = where_clause(where)
+        with conn:
+            self.add_columns(conn, table, changes)
+            conn.execute(
+                f'UPDATE "{table}" SET {", ".join(f"{quote(c)} = ?" for c in changes)} {condition}',
+                list(changes.values()) + params
+            )
+            self.bump_version(conn, table)
+
+    def delete(self, file, where):
+        conn = self.connect()
+        table = table_name(file)
+        condition, params = where_clause(where)
+        with conn:
+            conn.execute(f'DELETE FROM "{table}" {condition}', params)
+            self.bump_version(conn, table)
+
+    def find(self, file, where):
+        condition, params = where_clause(where)
+        return self.query(file, condition + ' ORDER BY rowid', params)
+
+    def count(self, file, sql='', params=()):
+        return self.connect().execute(f'SELECT COUNT(*) FROM "{table_name(file)}" {sql}', params).fetchone()[0]
+
+    def next_id(self, file, column):
+        conn = self.connect()
+        table = table_name(file)
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT value FROM sequences WHERE name = ?', (table,)).fetchone()
+            if row is None:
+                # Seed from the highest ID already in the table, once
+                row = conn.execute(f'SELECT MAX(CAST({quote(column)} AS INTEGER)) FROM "{table}"').fetchone()
+            value = (row[0] or 0) + 1
+            conn.execute(
+                'INSERT INTO sequences (name, value) VALUES (?, ?) '
+                'ON CONFLICT(name) DO UPDATE SET value = excluded.value',
+                (table, value)
+            )
+        return value
+
+    # Write counter per table, bumped in the same transaction as the write
+    def version(self, file):
+        row = self.connect().execute('SELECT version FROM table_versions WHERE name = ?', (table_name(file),)).fetchone()
+        return row[0] if row else 0
+
+    def bump_version(self, conn, table):
+        conn.execute(
+            'INSERT INTO table_versions (name, version) VALUES (?, 1) '
+            'ON CONFLICT(name) DO UPDATE SET version = version + 1',
+            (table,)
+        )
+
+
+# Typed tables in Feather (Arrow IPC) files next to the CSVs: loads skip text parsing and can
+# read a subset of columns. Writes rewrite the table file, so this suits read-heavy deployments.
+# A table without a Feather file yet is imported from its CSV when the backend is opened.
+class FeatherStorage:
+    indexed = False
+    columnar = True
+
+    def __init__(self):
+        self.imported = []
+        # Several app processes may start at once; only one imports each table
+        for file in TABLE_COLUMNS:
+            if not os.path.exists(self.path(file)):
+                with file_lock(file):
+                    if not os.path.exists(self.path(file)):
+                        self.import_csv(file)
+                        self.imported.append(file)
+
+    # The CSV with its pending journal entries; not CsvStorage.load, whose compaction takes the
+    # same (non-reentrant) lock
+    def import_csv(self, file):
+        if os.path.exists(file):
+            data, entries = CsvStorage().read(file)
+            data = apply_journal(data, entries)
+        else:
+            data = pd.DataFrame(columns=TABLE_COLUMNS[file], dtype=object)
+        self.write(file, prepare_table(file, data))
+
+    def path(self, file):
+        return os.path.splitext(file)[0] + FEATHER_SUFFIX
+
+    def load(self, file, columns=None):
+        return pd.read_feather(self.path(file), columns=columns)
+
+    def save(self, file, data):
+        with file_lock(file):
+            self.write(file, prepare_table(file, data.copy()))
+
+    # `data` is already typed
+    def write(self, file, data):
+        tmp_file = self.path(file) + '.tmp'
+        data.reset_index(drop=True).to_feather(tmp_file)
+        os.replace(tmp_file, self.path(file))
+
+    def rows(self, file, rows):
+        return prepare_table(file, pd.DataFrame(rows, dtype=object))
+
+    def append(self, file, rows):
+        with file_lock(file):
+            data = self.load(file)
+            new_rows = self.rows(file, rows)
+            if data.empty:
+                self.write(file, new_rows.reindex(columns=data.columns))
+                return
+            data = pd.concat([data, new_rows], ignore_index=True)
+            # Categoricals with different (extra) categories concatenate to plain objects
+            for column, kind in TABLE_SCHEMAS.get(file, {}).items():
+                if isinstance(kind, pd.CategoricalDtype) and column in data.columns and data[column].dtype == object:
+                    data[column] = parse_category(data[column], kind)
+            self.write(file, data)
+
+    def update(self, file, where, changes):
+        with file_lock(file):
+            # Arrays read from Feather may be read-only
+            data = self.load(file).copy()
+            mask = match_rows(data, where, TABLE_SCHEMAS.get(file))
+            for column, value in self.rows(file, [changes]).iloc[0].items():
+                data.loc[mask, column] = value
+            self.write(file, data)
+
+    def delete(self, file, where):
+        with file_lock(file):
+            data = self.load(file)
+            self.write(file, data[~match_rows(data, where, TABLE_SCHEMAS.get(file))])
+
+    next_id = CsvStorage.next_id
+
+    def upgrade(self, file, columns):
+        with file_lock(file):
+            data = self.load(file)
+            missing = [column for column in columns if column not in data.columns]
+            if missing:
+                added = self.rows(file, pd.DataFrame(None, index=data.index, columns=missing, dtype=object))
+                self.write(file, pd.concat([data, added], axis=1))
+
+    def version(self, file):
+        try:
+            stat = os.stat(self.path(file))
+            return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return (0, 0, 0)
+
+# Import the CSV tables into the Feather backend ahead of time. Tables that already have a
+# Feather file are left alone, so running it again never overwrites newer data.
+def migrate_to_feather():
+    storage = FeatherStorage()
+    for file in TABLE_COLUMNS:
+        print(f"{file} -> {storage.path(file)}" + ("" if file in storage.imported else " (already imported)"))
+
+
+# Process-wide resources. Streamlit reruns only the page script, and this module is imported
+# once per process, so a plain memo is shared by all sessions
+shared_resource = functools.lru_cache(maxsize=None)
+
+@shared_resource
+def get_storage():
+    if STORAGE_BACKEND == 'sqlite':
+        return SqliteStorage(SQLITE_DB_FILE)
+    if STORAGE_BACKEND == 'feather':
+        return FeatherStorage()
+    return CsvStorage()
+
+# Parsed tables shared by all sessions: file -> (version, data)
+@shared_resource
+def get_table_cache():
+    return {'tables': {}, 'locks': {file: threading.Lock() for file in TABLE_COLUMNS}}
+
+def invalidate_table(file):
+    tables = get_table_cache()['tables']
+    for key in [key for key in tables if key == file or (isinstance(key, tuple) and key[0] == file)]:
+        tables.pop(key, None)
+
+def invalidate_tables():
+    get_table_cache()['tables'].clear()
+
+# Utility functions
+# `columns` limits the result to those columns; columnar backends then read only those from disk
+def load_data(file, columns=None):
+    storage = get_storage()
+    if columns is not None and not storage.columnar:
+        return load_data(file)[columns]
+    key = file if columns is None else (file, tuple(columns))
+    cache = get_table_cache()
+    # One session parses a changed table while the others wait for its result
+    with cache['locks'].setdefault(file, threading.Lock()):
+        version = storage.version(file)
+        cached = cache['tables'].get(key)
+        if cached is None or cached[0] != version:
+            cached = (version, storage.load(file) if columns is None else storage.load(file, list(columns)))
+            cache['tables'][key] = cached
+    return cached[1].copy()
+
+def save_data(file, data):
+    get_storage().save(file, serialize_table(data))
+    invalidate_table(file)
+
+# Insert new rows without rewriting the table
+def append_data(file, rows):
+    if isinstance(rows, dict):
+        rows = [rows]
+    get_storage().append(file, [{column: to_cell(value) for column, value in row.items()} for row in rows])
+    invalidate_table(file)
+
+# Update the rows matching `where`
+def update_data(file, where, changes):
+    get_storage().update(file, {k: to_cell(v) for k, v in where.items()}, {k: to_cell(v) for k, v in changes.items()})
+    invalidate_table(file)
+
+# Delete the rows matching `where`
+def delete_data(file, where):
+    get_storage().delete(file, {k: to_cell(v) for k, v in where.items()})
+    invalidate_table(file)
+
+# Point query: the rows matching `where` (indexed in the SQLite backend)
+def find_data(file, where):
+    where = {k: to_cell(v) for k, v in where.items()}
+    storage = get_storage()
+    if storage.indexed:
+        return storage.find(file, where)
+    data = load_data(file)
+    return data[match_rows(data, where, TABLE_SCHEMAS.get(file))]
+
+# Next ID for a table; IDs are never reused, even after rows are deleted
+def next_id(file):
+    return get_storage().next_id(file, TABLE_ID_COLUMNS[file])
+
+# Fold pending journal entries into the table
+def compact_data(file):
+    save_data(file, load_data(file))
+
+# Typed view of a table as stored (all strings); unparseable cells become NA
+def prepare_table(file, data):
+    schema = TABLE_SCHEMAS.get(file, {})
+    for column in data.columns:
+        if data[column].dtype == 'object':
+            data[column] = data[column].str.strip()
+        if column in schema:
+            data[column] = parse_column(data[column], schema[column])
+    return data
+
+def parse_column(values, kind):
+    if kind == 'int':
+        return pd.to_numeric(values, errors='coerce').astype('Int64')
+    if kind == 'bool':
+        return values.eq('True')
+    if kind == 'datetime':
+        return pd.to_datetime(values, format='ISO8601', errors='coerce')
+    if kind == 'time':
+        return pd.to_timedelta(values.str.replace(r'^(\d{1,2}:\d{2})$', r'\1:00', regex=True), errors='coerce')
+    return parse_category(values, kind)
+
+# Categories match in any letter case (older versions wrote 'registered'); any other value is
+# kept as an extra category, so saving the table back never blanks it
+def parse_category(values, dtype):
+    values = values.astype(object)
+    values = values.where(values.notna() & (values != ''), None)
+    canonical = {str(category).lower(): category for category in dtype.categories}
+    values = values.str.lower().map(canonical).fillna(values)
+    extra = sorted(set(values.dropna()) - set(dtype.categories))
+    if extra:
+        dtype = pd.CategoricalDtype(list(dtype.categories) + extra)
+    return values.astype(dtype)
+
+# Back to storage cells, the inverse of prepare_table
+def serialize_table(data):
+    return pd.DataFrame({column: serialize_column(data[column]) for column in data.columns}, index=data.index)
+
+# Vectorized to_cell for one column
+def serialize_column(values):
+    missing = values.isna()
+    if pd.api.types.is_datetime64_any_dtype(values):
+        # Formatting with a space is much faster in pandas than with 'T'
+        text = pd.Series(None, index=values.index, dtype=object)
+        midnight = values == values.dt.normalize()
+        fraction = values.dt.microsecond != 0
+        for mask, date_format in ((midnight, '%Y-%m-%d'), (~midnight & ~fraction, '%Y-%m-%d %H:%M:%S'), (fraction, '%Y-%m-%d %H:%M:%S.%f')):
+            if mask.any():
+                text[mask] = values[mask].dt.strftime(date_format)
+        text = text.str.replace(' ', 'T', regex=False)
+    elif pd.api.types.is_timedelta64_dtype(values):
+        seconds = values.dt.total_seconds().fillna(0).astype('int64')
+        text = (seconds // 3600).astype(str).str.zfill(2) + ':' + (seconds % 3600 // 60).astype(str).str.zfill(2) + ':' + (seconds % 60).astype(str).str.zfill(2)
+    elif pd.api.types.is_bool_dtype(values) or pd.api.types.is_integer_dtype(values):
+        text = values.astype(str)
+    elif pd.api.types.infer_dtype(values, skipna=True) in ('string', 'empty'):
+        text = values
+    else:
+        return values.astype(object).map(to_cell)
+    return text.astype(object).where(~missing, None)
+
+def to_cell(value):
+    if isinstance(value, str):
+        return value
+    if value is None or value is pd.NA or value is pd.NaT or (isinstance(value, float) and pd.isna(value)):
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.strftime('%Y-%m-%d') if value == value.normalize() else value.isoformat()
+    if isinstance(value, pd.Timedelta):
+        seconds = int(value.total_seconds())
+        return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+    return str(value)
+
+def format_date(value):
+    return '' if pd.isna(value) else value.strftime('%Y-%m-%d')
+
+def format_time(value):
+    return '' if pd.isna(value) else to_cell(value)[:5]
+
+def table_name(file):
+    return os.path.splitext(os.path.basename(file))[0]
+
+def quote(column):
+    return '"' + column.replace('"', '""') + '"'
+
+def where_clause(where):
+    if not where:
+        return '', []
+    conditions = [f'{quote(c)} IS NULL' if v is None else f'{quote(c)} = ?' for c, v in where.items()]
+    return 'WHERE ' + ' AND '.join(conditions), [v for v in where.values() if v is not None]
+
+# Case-insensitive prefix search over `columns`: rows where any of them starts with `text`.
+# A prefix LIKE can use the columns' NOCASE indexes (TABLE_SEARCH_INDEXES); '%text%' could not.
+def search_clause(columns, text):
+    if not text:
+        return '', []
+    pattern = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    return 'WHERE ' + ' OR '.join(f"{quote(c)} LIKE ? ESCAPE '\\'" for c in columns), [pattern] * len(columns)
+
+# Rows matching `where`; with a schema, typed columns compare on the parsed value
+def match_rows(data, where, schema=None):
+    mask = pd.Series(True, index=data.index)
+    for column, value in where.items():
+        if column not in data.columns:
+            mask &= value is None
+        elif value is None:
+            mask &= data[column].isna()
+        elif schema and column in schema:
+            value = parse_column(pd.Series([value], dtype=object), schema[column]).iloc[0]
+            mask &= (data[column] == value).fillna(False).astype(bool)
+        else:
+            mask &= data[column].str.strip() == value.strip()
+    return mask
+
+# Exclusive lock shared by threads and, where fcntl is available, processes
+@contextlib.contextmanager
+def file_lock(path):
+    with get_process_locks().setdefault(path, threading.Lock()):
+        with open(path + '.lock', 'a') as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+@shared_resource
+def get_process_locks():
+    return {}
+
+def journal_path(file):
+    return file + JOURNAL_SUFFIX
+
+# Replay journal entries over the table in one pass: all inserted rows are appended up front, and
+# each update/delete finds its rows through a dict on its `where` columns instead of scanning
+# the table, only seeing rows that were inserted (and not deleted) before it
+def apply_journal(data, entries):
+    if not entries:
+        return data
+    inserts = [entry['row'] for entry in entries if entry['op'] == 'insert']
+    if inserts:
+        data = pd.concat([data, pd.DataFrame(inserts, dtype='str')], ignore_index=True)
+    else:
+        data = data.reset_index(drop=True)
+    for column in data.columns:
+        if data[column].dtype == 'object':
+            data[column] = data[column].str.strip()
+    existing = len(data) - len(inserts)
+    deleted = set()
+    indexes = {}
+    for entry in entries:
+        if entry['op'] == 'insert':
+            existing += 1
+            continue
+        rows = [row for row in journal_matches(data, indexes, entry['where']) if row < existing and row not in deleted]
+        if entry['op'] == 'update':
+            for column, value in entry['set'].items():
+                if column not in data.columns:
+                    data[column] = None
+                data.loc[rows, column] = value.strip() if isinstance(value, str) else value
+            # Lookups on a changed column need a fresh dict
+            for columns in [columns for columns in indexes if set(columns) & set(entry['set'])]:
+                del indexes[columns]
+        elif entry['op'] == 'delete':
+            deleted.update(rows)
+    if deleted:
+        data = data.drop(index=list(deleted)).reset_index(drop=True)
+    return data
+
+# Row positions matching `where` (same rules as match_rows); `indexes` caches one
+# {values: positions} dict per set of columns
+def journal_matches(data, indexes, where):
+    if any(value is not None for column, value in where.items() if column not in data.columns):
+        return []
+    columns = tuple(sorted(column for column in where if column in data.columns))
+    if not columns:
+        return range(len(data))
+    if columns not in indexes:
+        index = collections.defaultdict(list)
+        keys = data[list(columns)].astype(object)
+        for row, key in enumerate(keys.where(keys.notna(), None).itertuples(index=False, name=None)):
+            index[key].append(row)
+        indexes[columns] = index
+    key = tuple(where[column].strip() if isinstance(where[column], str) else None for column in columns)
+    return indexes[columns].get(key, [])
+
+def blob_path(file_hash):
+    return os.path.join(BLOB_DIR, file_hash[:2], file_hash)
+
+class BlobTooLarge(Exception):
+    pass
+
+# One blob being written chunk by chunk to a temporary file and hashed on the way;
+# finish() moves it under its hash and returns (hash, size), discard() drops it
+class BlobWriter:
+    def __init__(self, max_size=None):
+        os.makedirs(BLOB_DIR, exist_ok=True)
+        self.max_size = max_size
+        self.digest = hashlib.sha256()
+        self.size = 0
+        fd, self.tmp_path = tempfile.mkstemp(dir=BLOB_DIR, suffix='.tmp')
+        self.out = os.fdopen(fd, 'wb')
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.max_size is not None and self.size > self.max_size:
+            raise BlobTooLarge(self.max_size)
+        self.digest.update(chunk)
+        self.out.write(chunk)
+
+    def finish(self):
+        self.out.close()
+        file_hash = self.digest.hexdigest()
+        path = blob_path(file_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.remove(self.tmp_path)
+        else:
+            os.replace(self.tmp_path, path)
+        return file_hash, self.size
+
+    def discard(self):
+        self.out.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+# Copy a file object into the blob store in chunks; returns (hash, size)
+def store_blob(fileobj, max_size=None):
+    writer = BlobWriter(max_size)
+    try:
+        for chunk in iter(lambda: fileobj.read(BLOB_CHUNK_SIZE), b''):
+            writer.write(chunk)
+        return writer.finish()
+    except BaseException:
+        writer.discard()
+        raise
+
+def read_blob(file_hash):
+    with open(blob_path(file_hash), 'rb') as f:
+        return f.read()
+
+def format_size(size):
+    if pd.isna(size):
+        return "unknown size"
+    size = float(size)
+    for unit in ['B', 'KB', 'MB']:
+        if size < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+# Store an uploaded file and record its metadata in the files table
+def save_upload(user_id, filename, fileobj, from_admin):
+    file_hash, size = store_blob(fileobj)
+    record_upload(user_id, filename, file_hash, size, from_admin)
+
+# Append the metadata row of a file already in the blob store
+def record_upload(user_id, filename, file_hash, size, from_admin):
+    append_data(FILES_DATA_FILE, {
+        'UserID': user_id,
+        'Filename': filename,
+        'Hash': file_hash,
+        'Size': size,
+        'FromAdmin': bool(from_admin)
+    })
+
+# Bytes of a legacy 'FileData' cell: str(list(bytes)) from the web app or a bytearray repr from the bot
+def legacy_file_bytes(value):
+    if value.startswith('bytearray('):
+        return bytes(ast.literal_eval(value[len('bytearray('):-1]))
+    return bytes(ast.literal_eval(value))
+
+# Bring tables created by older versions of the app up to TABLE_COLUMNS, once per process
+@shared_resource
+def upgrade_tables():
+    for file, columns in TABLE_COLUMNS.items():
+        get_storage().upgrade(file, columns)
+    invalidate_tables()
+
+# One-shot move of legacy 'FileData' cells from the files table into the blob store
+@shared_resource
+def migrate_file_blobs():
+    files = load_data(FILES_DATA_FILE)
+    if 'FileData' not in files.columns or ('Hash' in files.columns and files['FileData'].isna().all()):
+        return
+    for index in files.index[files['FileData'].notna()]:
+        file_hash, size = store_blob(BytesIO(legacy_file_bytes(files.at[index, 'FileData'])))
+        files.at[index, 'Hash'] = file_hash
+        files.at[index, 'Size'] = size
+    save_data(FILES_DATA_FILE, files.drop(columns=['FileData']))
+
+# One-shot: give messages saved by older versions an ID and an inbox status
+@shared_resource
+def migrate_message_ids():
+    messages = load_data(CONTACT_DATA_FILE)
+    pending = messages['MessageID'].isna() | messages['Status'].isna()
+    if not pending.any():
+        return
+    for index in messages.index[messages['MessageID'].isna()]:
+        messages.at[index, 'MessageID'] = next_id(CONTACT_DATA_FILE)
+    answered = messages['Response'].fillna('').str.strip() != ''
+    messages.loc[pending, 'Status'] = answered[pending].map({True: 'answered', False: 'unread'})
+    save_data(CONTACT_DATA_FILE, messages)
+
+# New unread message from a user to the admin
+def send_contact_message(user_id, subject, message):
+    append_data(CONTACT_DATA_FILE, {
+        'MessageID': next_id(CONTACT_DATA_FILE),
+        'UserID': user_id,
+        'Subject': subject,
+        'Message': message,
+        'Response': '',  # Initialize with empty response
+        'Sent At': datetime.now().isoformat(timespec='seconds'),
+        'Status': 'unread'
+    })
+
+# Answer one message: a journal entry with the CSV backend, a single-row UPDATE with SQLite
+def respond_to_message(message_id, response):
+    update_data(CONTACT_DATA_FILE, {'MessageID': message_id}, {'Response': response, 'Status': 'answered'})
+
+# Username -> user record and ID -> user record, shared by all sessions and rebuilt once per
+# users table version. Our own sign-ups are added directly; changes made elsewhere (e.g. by the
+# Telegram bot) are picked up when the version is re-checked, at the latest after
+# USER_INDEX_REVALIDATE_SECONDS, and right away when a username is not found.
+USER_INDEX_REVALIDATE_SECONDS = 5
+
+# Held while a new username is checked against the stored table and inserted, by every process
+SIGN_UP_LOCK = USER_DATA_FILE + '.signup'
+
+@shared_resource
+def get_user_index():
+    return {'version': None, 'checked': 0.0, 'users': {}, 'ids': {}, 'lock': threading.Lock()}
+
+def refresh_user_index(force=False):
+    index = get_user_index()
+    if force or time.monotonic() - index['checked'] > USER_INDEX_REVALIDATE_SECONDS:
+        with index['lock']:
+            version = get_storage().version(USER_DATA_FILE)
+            if version != index['version']:
+                by_username, by_id = {}, {}
+                # First row wins for duplicate usernames and IDs
+                for user in load_data(USER_DATA_FILE).to_dict('records'):
+                    by_username.setdefault(user['Username'], user)
+                    by_id.setdefault(user['ID'], user)
+                index['users'], index['ids'] = by_username, by_id
+                index['version'] = version
+            index['checked'] = time.monotonic()
+    return index
+
+def lookup_user(username):
+    user = refresh_user_index()['users'].get(username)
+    if user is None:
+        user = refresh_user_index(force=True)['users'].get(username)
+    return user
+
+# ID -> user record for resolving UserID columns
+def get_user_map():
+    return refresh_user_index()['ids']
+
+# Users table plus a lowercase search key per user ('\n' before each searched column, so a
+# prefix search is a substring search for '\n' + text), rebuilt once per users table version
+USER_SEARCH_COLUMNS = TABLE_SEARCH_INDEXES[USER_DATA_FILE]
+
+@shared_resource
+def get_user_directory():
+    return {'version': None, 'users': None, 'search': None, 'lock': threading.Lock()}
+
+def refresh_user_directory():
+    directory = get_user_directory()
+    with directory['lock']:
+        version = get_storage().version(USER_DATA_FILE)
+        if version != directory['version']:
+            users = load_data(USER_DATA_FILE)
+            search = pd.Series('', index=users.index)
+            for column in USER_SEARCH_COLUMNS:
+                search += '\n' + users[column].fillna('').astype(str).str.lower()
+            directory['users'], directory['search'] = users, search
+            directory['version'] = version
+    return directory
+
+def user_matches(search):
+    directory = refresh_user_directory()
+    if not search:
+        return directory['users']
+    return directory['users'][directory['search'].str.contains('\n' + search.lower(), regex=False)]
+
+# Number of users whose name, last name, username or Telegram ID starts with `search`
+def count_users(search=''):
+    search = search.strip()
+    storage = get_storage()
+    if storage.indexed:
+        condition, params = search_clause(USER_SEARCH_COLUMNS, search)
+        return storage.count(USER_DATA_FILE, condition, params)
+    return len(user_matches(search))
+
+# One page of the users matching `search`, sorted by `order`
+def search_users(search, order, descending, offset, limit):
+    search = search.strip()
+    storage = get_storage()
+    if storage.indexed:
+        condition, params = search_clause(USER_SEARCH_COLUMNS, search)
+        order_by = f'CAST({quote(order)} AS INTEGER)' if TABLE_SCHEMAS[USER_DATA_FILE].get(order) == 'int' else quote(order)
+        direction = 'DESC' if descending else 'ASC'
+        return storage.query(USER_DATA_FILE, f'{condition} ORDER BY {order_by} {direction}, rowid LIMIT ? OFFSET ?', params + [limit, offset])
+    users = user_matches(search).sort_values(order, ascending=not descending, kind='stable')
+    return users.iloc[offset:offset + limit]
+
+# Insert a new user and add it to the user index. Returns False, without inserting, if the
+# username is already taken
+def add_user(user_data):
+    with file_lock(SIGN_UP_LOCK):
+        if username_exists(user_data['Username']):
+            return False
+        append_data(USER_DATA_FILE, user_data)
+    user = prepare_table(USER_DATA_FILE, pd.DataFrame([{column: to_cell(value) for column, value in user_data.items()}], dtype=object)).to_dict('records')[0]
+    index = get_user_index()
+    # Under the index lock, so a concurrent rebuild cannot replace the dicts and drop the new user
+    with index['lock']:
+        index['users'].setdefault(user['Username'], user)
+        index['ids'].setdefault(user['ID'], user)
+    return True
+
+# Check credentials
+def check_credentials(username, password):
+    user = lookup_user(username)
+    if user is not None:
+        stored_password = user['Password']
+        return stored_password == password
+    return False
+
+# Check if username exists
+def username_exists(username):
+    return lookup_user(username) is not None
+
+# Look up a user's ID by username
+def get_user_id(username):
+    return lookup_user(username)['ID']
+
+# Registered/reserve counts per event and one user's status per event, in one pass
+def registration_summary(registrations, user_id):
+    counts = registrations.groupby(['EventID', 'Status'], observed=True).size().to_dict()
+    mine = registrations[registrations['UserID'] == user_id]
+    user_status = dict(zip(mine['EventID'], mine['Status']))
+    return counts, user_status
+
+# Events from today on (soonest first) or before today (latest first) whose name, location or
+# description contains `search`; undated events count as upcoming
+def filter_events(events, when, search=''):
+    today = pd.Timestamp.today().normalize()
+    if when == 'Past':
+        events = events[events['Date'] < today].sort_values('Date', ascending=False, kind='stable')
+    else:
+        events = events[~(events['Date'] < today)].sort_values('Date', kind='stable', na_position='last')
+    if search.strip():
+        text = events['Event Name'].fillna('') + ' ' + events['Location'].fillna('') + ' ' + events['Description'].fillna('')
+        events = events[text.str.contains(search.strip(), case=False, regex=False)]
+    return events
+
+# Registrations joined to users once and split into {(EventID, Status): rows}. Rows are put in
+# waitlist order before the join, and the left join keeps that order (an inner join regroups
+# rows by key), so each Reserve List matches the order promotions use
+ROSTER_COLUMNS = ['Name', 'Last Name', 'Mobile Number', 'Telegram ID', 'Username']
+
+def build_rosters(registrations, users):
+    roster = pd.merge(order_waitlist(registrations), users, left_on='UserID', right_on='ID', how='left')
+    roster = roster[roster['ID'].notna()]
+    return {key: group[ROSTER_COLUMNS] for key, group in roster.groupby(['EventID', 'Status'], observed=True)}
+
+# Exports are written a chunk of EXPORT_CHUNK_ROWS rows at a time (csv, or openpyxl write-only
+# mode) to a file, so building one never holds the joined table or a whole workbook in memory
+EXPORT_CHUNK_ROWS = 10000
+EXPORT_MIME_TYPES = {
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'csv': 'text/csv',
+}
+ROSTER_EXPORT_COLUMNS = ['EventID', 'Event Name', 'Date', 'Status', 'Joined At', 'UserID'] + ROSTER_COLUMNS
+
+# Roster rows for one event (or all), main list first, then the waitlist in order
+def roster_export_chunks(event_id=None):
+    events = load_data(EVENT_DATA_FILE, ['EventID', 'Event Name', 'Date']).drop_duplicates('EventID')
+    users = load_data(USER_DATA_FILE, ['ID'] + ROSTER_COLUMNS).drop_duplicates('ID')
+    if event_id is None:
+        registrations = load_data(REGISTRATION_DATA_FILE)
+    else:
+        registrations = find_data(REGISTRATION_DATA_FILE, {'EventID': event_id})
+    registrations = order_waitlist(registrations).sort_values(['EventID', 'Status'], kind='stable')
+    for start in range(0, len(registrations), EXPORT_CHUNK_ROWS):
+        chunk = registrations.iloc[start:start + EXPORT_CHUNK_ROWS]
+        # Left merges keep the chunk's row order (inner merges regroup rows by key)
+        chunk = chunk[chunk['EventID'].isin(events['EventID']) & chunk['UserID'].isin(users['ID'])]
+        chunk = chunk.merge(events, on='EventID', how='left').merge(users, left_on='UserID', right_on='ID', how='left')
+        yield serialize_table(chunk[ROSTER_EXPORT_COLUMNS])
+
+def event_export_chunks():
+    events = load_data(EVENT_DATA_FILE)
+    for start in range(0, len(events), EXPORT_CHUNK_ROWS):
+        yield serialize_table(events.iloc[start:start + EXPORT_CHUNK_ROWS])
+
+def write_export(path, columns, chunks, export_format):
+    if export_format == 'xlsx':
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        sheet.append(columns)
+        for chunk in chunks:
+            for row in chunk.itertuples(index=False, name=None):
+                sheet.append(row)
+        workbook.save(path)
+    else:
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            f.write(','.join(columns) + '\n')
+            for chunk in chunks:
+                chunk.to_csv(f, header=False, index=False)
+
+# Tables each export is built from
+EXPORT_SOURCES = {
+    'events': [EVENT_DATA_FILE],
+    'rosters': [EVENT_DATA_FILE, REGISTRATION_DATA_FILE, USER_DATA_FILE],
+}
+
+# Path of an export ('rosters' or 'events') under EXPORT_DIR. Files are named after the storage
+# versions of their source tables, so a stored export is reused until one of those tables
+# changes; the outdated file is then replaced by a new one.
+def build_export(kind, export_format, event_id=None):
+    storage = get_storage()
+    versions = repr([storage.version(file) for file in EXPORT_SOURCES[kind]])
+    name = kind if event_id is None else f"{kind}_{event_id}"
+    path = os.path.join(EXPORT_DIR, f"{name}-{hashlib.sha256(versions.encode()).hexdigest()[:16]}.{export_format}")
+    if os.path.exists(path):
+        return path
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=EXPORT_DIR, suffix='.tmp')
+    os.close(fd)
+    try:
+        if kind == 'events':
+            write_export(tmp_path, TABLE_COLUMNS[EVENT_DATA_FILE], event_export_chunks(), export_format)
+        else:
+            write_export(tmp_path, ROSTER_EXPORT_COLUMNS, roster_export_chunks(event_id), export_format)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    for old_file in os.listdir(EXPORT_DIR):
+        if old_file.startswith(name + '-') and old_file.endswith('.' + export_format) and old_file != os.path.basename(path):
+            with contextlib.suppress(OSError):
+                os.remove(os.path.join(EXPORT_DIR, old_file))
+    return path
+
+# Registration engine: capacity checks and the writes they guard run under one lock, so
+# parallel sessions (and app processes sharing the data directory) cannot overbook an event
+REGISTRATION_LOCK = REGISTRATION_DATA_FILE + '.register'
+
+# Per-event registration state: reserve queues of UserIDs in 'Joined At' order, each user's
+# status and the main list size. Our own registration writes update it in place, so registering
+# and cancelling never reparse the table; it is rebuilt only when the registrations table was
+# changed elsewhere.
+@shared_resource
+def get_waitlists():
+    return {'version': None, 'queues': {}, 'statuses': {}, 'registered': {}}
+
+# Reserve rows in waitlist order; rows from before 'Joined At' existed keep their file order, first
+def order_waitlist(reserve):
+    if 'Joined At' not in reserve.columns:
+        return reserve
+    return reserve.sort_values('Joined At', kind='stable', na_position='first')
+
+# Call with REGISTRATION_LOCK held
+def load_waitlists():
+    waitlists = get_waitlists()
+    version = get_storage().version(REGISTRATION_DATA_FILE)
+    if waitlists['version'] != version:
+        registrations = load_data(REGISTRATION_DATA_FILE)
+        reserve = order_waitlist(registrations[registrations['Status'] == 'Reserve'])
+        waitlists['queues'] = {
+            event_id: collections.deque(group['UserID'])
+            for event_id, group in reserve.groupby('EventID', sort=False)
+        }
+        # First row wins for a duplicate registration
+        first = registrations.drop_duplicates(['EventID', 'UserID'])
+        waitlists['statuses'] = {
+            event_id: dict(zip(group['UserID'], group['Status']))
+            for event_id, group in first.groupby('EventID', sort=False)
+        }
+        waitlists['registered'] = registrations[registrations['Status'] == 'Registered'].groupby('EventID').size().to_dict()
+        waitlists['version'] = version
+    return waitlists
+
+# Call with REGISTRATION_LOCK held, after our own write has been applied to the waitlists
+def mark_waitlists_current():
+    get_waitlists()['version'] = get_storage().version(REGISTRATION_DATA_FILE)
+
+# Returns the user's status for the event: 'Registered', 'Reserve', 'Full' if both lists are
+# full, or 'Missing' if the event no longer exists (e.g. removed after the page was shown)
+def register_for_event(user_id, event_id):
+    user_id, event_id = int(user_id), int(event_id)
+    with file_lock(REGISTRATION_LOCK):
+        waitlists = load_waitlists()
+        if user_id in waitlists['statuses'].get(event_id, {}):
+            return waitlists['statuses'][event_id][user_id]
+        events = find_data(EVENT_DATA_FILE, {'EventID': event_id})
+        if events.empty:
+            return 'Missing'
+        event = events.iloc[0]
+        statuses = waitlists['statuses'].setdefault(event_id, {})
+        queue = waitlists['queues'].setdefault(event_id, collections.deque())
+        if waitlists['registered'].get(event_id, 0) < int(event['Max Volunteers']):
+            status = 'Registered'
+        elif len(queue) < int(event['Reserve Capacity']):
+            status = 'Reserve'
+        else:
+            return 'Full'
+        append_data(REGISTRATION_DATA_FILE, {
+            'UserID': user_id,
+            'EventID': event_id,
+            'Status': status,
+            'Joined At': datetime.now().isoformat(timespec='microseconds')
+        })
+        statuses[user_id] = status
+        if status == 'Reserve':
+            queue.append(user_id)
+        else:
+            waitlists['registered'][event_id] = waitlists['registered'].get(event_id, 0) + 1
+        mark_waitlists_current()
+        return status
+
+# Cancel a registration; a main list cancellation promotes the head of the event's waitlist if
+# that leaves the main list below Max Volunteers (it may still be over a lowered limit).
+# Returns the promoted UserID, or None
+def cancel_registration(user_id, event_id):
+    user_id, event_id = int(user_id), int(event_id)
+    promoted = None
+    with file_lock(REGISTRATION_LOCK):
+        waitlists = load_waitlists()
+        statuses = waitlists['statuses'].get(event_id, {})
+        if user_id not in statuses:
+            return None
+        status = statuses.pop(user_id)
+        delete_data(REGISTRATION_DATA_FILE, {'UserID': user_id, 'EventID': event_id})
+        queue = waitlists['queues'].get(event_id, collections.deque())
+        registered = waitlists['registered']
+        if status == 'Reserve':
+            if user_id in queue:
+                queue.remove(user_id)
+        else:
+            if status == 'Registered':
+                registered[event_id] -= 1
+            event = find_data(EVENT_DATA_FILE, {'EventID': event_id})
+            max_volunteers = event['Max Volunteers'].iloc[0] if not event.empty else pd.NA
+            if queue and not pd.isna(max_volunteers) and registered.get(event_id, 0) < int(max_volunteers):
+                promoted = queue.popleft()
+                update_data(REGISTRATION_DATA_FILE, {'UserID': promoted, 'EventID': event_id}, {'Status': 'Registered'})
+                statuses[promoted] = 'Registered'
+                registered[event_id] = registered.get(event_id, 0) + 1
+        mark_waitlists_current()
+    return promoted
+
+# Promote reserves into free main list places for the given events (default: all) in one
+# vectorized pass: rank each event's waitlist and promote the first (Max Volunteers - registered).
+# Run after bulk capacity edits or imports. Returns the number of promotions
+def rebalance_registrations(event_ids=None):
+    with file_lock(REGISTRATION_LOCK):
+        # Older versions could reuse an EventID; the first row is the event, as in register_for_event
+        events = load_data(EVENT_DATA_FILE, ['EventID', 'Max Volunteers']).drop_duplicates('EventID')
+        registrations = load_data(REGISTRATION_DATA_FILE)
+        if event_ids is not None:
+            events = events[events['EventID'].isin([int(event_id) for event_id in event_ids])]
+        registered = registrations[registrations['Status'] == 'Registered'].groupby('EventID').size()
+        capacity = events.set_index('EventID')['Max Volunteers']
+        free = (capacity - registered.reindex(capacity.index, fill_value=0)).clip(lower=0)
+
+        reserve = order_waitlist(registrations[registrations['Status'] == 'Reserve'])
+        rank = reserve.groupby('EventID').cumcount()
+        promote = reserve.index[(rank < reserve['EventID'].map(free).fillna(0)).to_numpy(dtype=bool)]
+        if len(promote) == 0:
+            return 0
+        registrations.loc[promote, 'Status'] = 'Registered'
+        save_data(REGISTRATION_DATA_FILE, registrations)
+        # Force the waitlists to be rebuilt from the new table
+        get_waitlists()['version'] = None
+        return len(promote)
+
+# Change event capacities in bulk ({EventID: (max volunteers, reserve capacity)}) and fill freed places
+def update_event_capacities(capacities):
+    for event_id, (max_volunteers, reserve_capacity) in capacities.items():
+        update_data(EVENT_DATA_FILE, {'EventID': event_id}, {'Max Volunteers': max_volunteers, 'Reserve Capacity': reserve_capacity})
+    return rebalance_registrations(list(capacities))
+
+# Delete an event together with its registrations and waitlist
+def remove_event(event_id):
+    event_id = int(event_id)
+    with file_lock(REGISTRATION_LOCK):
+        waitlists = load_waitlists()
+        delete_data(EVENT_DATA_FILE, {'EventID': event_id})
+        delete_data(REGISTRATION_DATA_FILE, {'EventID': event_id})
+        for state in ('queues', 'statuses', 'registered'):
+            waitlists[state].pop(event_id, None)
+        mark_waitlists_current()
+
@@ -1,68 +1,63 @@
 import streamlit as st
-import pandas as pd
-import os
+import sys
 from datetime import datetime
-from io import BytesIO
-
-# Directory for data files
-DATA_DIR = 'data'
-if not os.path.exists(DATA_DIR):
-    os.makedirs(DATA_DIR)
-
-# File paths
-USER_DATA_FILE = os.path.join(DATA_DIR, 'users.csv')
-EVENT_DATA_FILE = os.path.join(DATA_DIR, 'events.csv')
-REGISTRATION_DATA_FILE = os.path.join(DATA_DIR, 'registrations.csv')
-MESSAGES_DATA_FILE = os.path.join(DATA_DIR, 'messages.csv')
-FILES_DATA_FILE = os.path.join(DATA_DIR, 'files.csv')
-CONTACT_DATA_FILE = os.path.join(DATA_DIR, 'contact_data.csv')
-
-# Ensure files exist
-for file in [USER_DATA_FILE, EVENT_DATA_FILE, REGISTRATION_DATA_FILE, MESSAGES_DATA_FILE, FILES_DATA_FILE, CONTACT_DATA_FILE]:
-    if not os.path.exists(file):
-        if file == USER_DATA_FILE:
-            df = pd.DataFrame(columns=['ID', 'Name', 'Last Name', 'Mobile Number', 'Telegram ID', 'Username', 'Password'])
-        elif file == REGISTRATION_DATA_FILE:
-            df = pd.DataFrame(columns=['UserID', 'EventID', 'Status'])
-        elif file == MESSAGES_DATA_FILE:
-            df = pd.DataFrame(columns=['UserID', 'Message', 'Response'])
-        elif file == FILES_DATA_FILE:
-            df = pd.DataFrame(columns=['UserID', 'Filename', 'FileData', 'FromAdmin'])
-        elif file == CONTACT_DATA_FILE:
-            df = pd.DataFrame(columns=['UserID', 'Subject', 'Message'])
-        elif file == EVENT_DATA_FILE:
-            df = pd.DataFrame(columns=['EventID', 'Event Name', 'Date', 'Time', 'Day', 'Location', 'Description', 'Max Volunteers', 'Reserve Capacity'])
-
-        df.to_csv(file, index=False)
-
-# Utility functions
-def load_data(file):
-    data = pd.read_csv(file, dtype='str')
-    for column in data.columns:
-        if data[column].dtype == 'object':
-            data[column] = data[column].str.strip()
-    if 'Max Volunteers' in data.columns:
-        data['Max Volunteers'] = data['Max Volunteers'].astype(int)
-    if 'Status' in data.columns:
-        data['Status'] = data['Status'].astype(str)
-    return data
-
-def save_data(file, data):
-    data.to_csv(file, index=False)
-
-# Check credentials
-def check_credentials(username, password):
-    users = load_data(USER_DATA_FILE)
-    user = users[users['Username'] == username]
-    if not user.empty:
-        stored_password = user.iloc[0]['Password']
-        return stored_password == password
-    return False
-
-# Check if username exists
-def username_exists(username):
-    users = load_data(USER_DATA_FILE)
-    return username in users['Username'].values
+
+from events_store import (
+    CONTACT_DATA_FILE, EVENT_DATA_FILE, EXPORT_MIME_TYPES, FILES_DATA_FILE,
+    REGISTRATION_DATA_FILE, ROSTER_COLUMNS, USER_DATA_FILE, add_user, append_data, build_export,
+    build_rosters, cancel_registration, check_credentials, count_users, filter_events,
+    find_data, format_date, format_size, format_time, get_user_id, get_user_map, load_data,
+    migrate_file_blobs, migrate_message_ids, migrate_to_feather, next_id, read_blob,
+    register_for_event, registration_summary, remove_event, respond_to_message, save_upload,
+    search_users, send_contact_message, update_event_capacities, upgrade_tables, username_exists
+)
+
+# Download button that only reads the file from the blob store once it has been asked for;
+# st.download_button needs the whole payload, so at most one listed file is in memory
+def lazy_download_button(file, key):
+    requested = st.session_state.get('download_requested') == key
+    if not requested and not st.button(f"Prepare {file['Filename']} ({format_size(file['Size'])})", key=f"prepare_{key}"):
+        return
+    st.session_state['download_requested'] = key
+    st.download_button(
+        "Download",
+        data=read_blob(file['Hash']),
+        file_name=file['Filename'],
+        key=key,
+        on_click=st.session_state.pop,
+        args=('download_requested', None)
+    )
+
+# Page selector over `total` rows; returns the offset of the picked page. `key` keeps each
+# list's page in the session
+def page_offset(total, page_size, key):
+    pages = max(1, -(-total // page_size))
+    if st.session_state.get(key, 1) > pages:
+        st.session_state[key] = pages
+    page = st.number_input(f"Page (of {pages})", min_value=1, max_value=pages, step=1, key=key)
+    return (page - 1) * page_size
+
+def paginate(data, page_size, key):
+    offset = page_offset(len(data), page_size, key)
+    return data.iloc[offset:offset + page_size]
+
+# Like lazy_download_button: nothing is generated until the admin asks for the export
+def export_download_button(label, kind, export_format, key, event_id=None):
+    requested = st.session_state.get('download_requested') == key
+    if not requested and not st.button(label, key=f"prepare_{key}"):
+        return
+    st.session_state['download_requested'] = key
+    with open(build_export(kind, export_format, event_id), 'rb') as f:
+        data = f.read()
+    st.download_button(
+        "Download",
+        data=data,
+        file_name=f"{kind}.{export_format}" if event_id is None else f"{kind}_{event_id}.{export_format}",
+        mime=EXPORT_MIME_TYPES[export_format],
+        key=key,
+        on_click=st.session_state.pop,
+        args=('download_requested', None)
+    )
 
 
 # Sign up page
@@ -84,8 +79,7 @@ def sign_up():
             if username_exists(username):
                 st.error("Username already exists. Please choose a different username.")
             else:
-                users = load_data(USER_DATA_FILE)
-                user_id = len(users) + 1
+                user_id = next_id(USER_DATA_FILE)
                 user_data = {
                     'ID': str(user_id),
                     'Name': str(name),
@@ -95,9 +89,11 @@ def sign_up():
                     'Username': str(username),
                     'Password': str(password)
                 }
-                save_data(USER_DATA_FILE, pd.concat([users, pd.DataFrame([user_data])], ignore_index=True))
-                st.success("User registered successfully!")
-                st.session_state['page'] = 'login'
+                if add_user(user_data):
+                    st.success("User registered successfully!")
+                    st.session_state['page'] = 'login'
+                else:
+                    st.error("Username already exists. Please choose a different username.")
         else:
             st.error("Please fill out all fields.")
 
@@ -139,366 +135,400 @@ def logout():
         st.rerun()  # Refresh the app to go to the login page
 
 
-# Admin panel
-def admin_panel():
-    st.title("Admin Panel 🛠️")
-
-    tabs = st.tabs(["Create Event 🎉", "View Registered Users 📋", "Remove Event ❌", "View All Users 👥", "User Messages ✉️", "File Exchange 📂"])
-
-    # Create Event tab
-     # Create Event tab
-    with tabs[0]:
-        st.subheader("Create Event 🎉")
-        with st.form(key='create_event_form'):
-            event_name = st.text_input("Event Name", key="event_name")
-            event_date = st.date_input("Event Date", key="event_date", min_value=datetime.today())
-            event_time = st.time_input("Event Time", key="event_time")
-            event_day = st.selectbox("Event Day", ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"], key="event_day")
-            location = st.text_input("Event Location (Google Maps Link)", key="event_location")
-            description = st.text_area("Event Description", key="event_description")
-            max_volunteers = st.number_input("Max Volunteers", min_value=1, step=1, key="max_volunteers")
-            reserve_capacity = st.number_input("Reserve Capacity", min_value=1, step=1, key="reserve_capacity")
-
-            create_event_button = st.form_submit_button(label='Create Event')
-
-        if create_event_button:
-            if event_name and event_date and event_time and event_day and location and description and max_volunteers and reserve_capacity:
-                events = load_data(EVENT_DATA_FILE)
-                if event_name in events['Event Name'].values:
-                    st.error("Event name already exists. Please choose a different event name.")
-                else:
-                    event_id = len(events) + 1
-                    event_data = {
-                        'EventID': event_id,
-                        'Event Name': event_name,
-                        'Date': event_date,
-                        'Time': event_time,
-                        'Day': event_day,
-                        'Location': location,
-                        'Description': description,
-                        'Max Volunteers': max_volunteers,
-                        'Reserve Capacity': reserve_capacity
-                    }
-                    save_data(EVENT_DATA_FILE, pd.concat([events, pd.DataFrame([event_data])], ignore_index=True))
-                    st.success("Event created successfully! 🎉")
+# Create Event view
+def admin_create_event():
+    st.subheader("Create Event 🎉")
+    with st.form(key='create_event_form'):
+        event_name = st.text_input("Event Name", key="event_name")
+        event_date = st.date_input("Event Date", key="event_date", min_value=datetime.today())
+        event_time = st.time_input("Event Time", key="event_time")
+        event_day = st.selectbox("Event Day", ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"], key="event_day")
+        location = st.text_input("Event Location (Google Maps Link)", key="event_location")
+        description = st.text_area("Event Description", key="event_description")
+        max_volunteers = st.number_input("Max Volunteers", min_value=1, step=1, key="max_volunteers")
+        reserve_capacity = st.number_input("Reserve Capacity", min_value=1, step=1, key="reserve_capacity")
+
+        create_event_button = st.form_submit_button(label='Create Event')
+
+    if create_event_button:
+        if event_name and event_date and event_time and event_day and location and description and max_volunteers and reserve_capacity:
+            events = load_data(EVENT_DATA_FILE, ['Event Name'])
+            if event_name in events['Event Name'].values:
+                st.error("Event name already exists. Please choose a different event name.")
             else:
-                st.error("Please fill out all fields.")
-
-    # View Registered Users tab
-    with tabs[1]:
-        st.subheader("Registered Users for Events 📋")
-        events = load_data(EVENT_DATA_FILE)
-        registrations = load_data(REGISTRATION_DATA_FILE)
-        users = load_data(USER_DATA_FILE)
-
-        for _, event in events.iterrows():
-            with st.expander(f"{event['Event Name']} on {event['Date']}"):
-                main_list = registrations[(registrations['EventID'] == str(event['EventID'])) & (registrations['Status'] == 'Registered')]
-                reserve_list = registrations[(registrations['EventID'] == str(event['EventID'])) & (registrations['Status'] == 'Reserve')]
-
-                if not main_list.empty:
-                    st.write("**Main List**")
-                    main_list_users = pd.merge(main_list, users, left_on='UserID', right_on='ID', how='inner')
-                    st.write(main_list_users[['Name', 'Last Name', 'Mobile Number', 'Telegram ID', 'Username']])
-
-                if not reserve_list.empty:
-                    st.write("**Reserve List**")
-                    reserve_list_users = pd.merge(reserve_list, users, left_on='UserID', right_on='ID', how='inner')
-                    st.write(reserve_list_users[['Name', 'Last Name', 'Mobile Number', 'Telegram ID', 'Username']])
-
-    # Remove Event tab
-    with tabs[2]:
-        st.subheader("Remove Event ❌")
-        events = load_data(EVENT_DATA_FILE)
-        registrations = load_data(REGISTRATION_DATA_FILE)
-        event_to_remove = st.selectbox("Select Event to Remove", events['Event Name'])
-        if st.button("Remove Event"):
-            event_id = events[events['Event Name'] == event_to_remove]['EventID'].values[0]
-            events = events[events['EventID'] != event_id]
-            registrations = registrations[registrations['EventID'] != event_id]
-            save_data(EVENT_DATA_FILE, events)
-            save_data(REGISTRATION_DATA_FILE, registrations)
-            st.success("Event removed successfully! ❌")
-
-    # View All Users tab
-    with tabs[3]:
-        st.subheader("All Users 👥")
-        users = load_data(USER_DATA_FILE)
+                event_id = next_id(EVENT_DATA_FILE)
+                event_data = {
+                    'EventID': event_id,
+                    'Event Name': event_name,
+                    'Date': event_date,
+                    'Time': event_time,
+                    'Day': event_day,
+                    'Location': location,
+                    'Description': description,
+                    'Max Volunteers': max_volunteers,
+                    'Reserve Capacity': reserve_capacity
+                }
+                append_data(EVENT_DATA_FILE, event_data)
+                st.success("Event created successfully! 🎉")
+        else:
+            st.error("Please fill out all fields.")
+
+# Registered users per event
+def admin_rosters():
+    st.subheader("Registered Users for Events 📋")
+    events = load_data(EVENT_DATA_FILE)
+    registrations = load_data(REGISTRATION_DATA_FILE)
+    users = load_data(USER_DATA_FILE, ['ID'] + ROSTER_COLUMNS)
+    rosters = build_rosters(registrations, users)
+
+    export_format = st.radio("Export format", ['xlsx', 'csv'], horizontal=True, key="export_format")
+    export_download_button("Export All Rosters", 'rosters', export_format, key="export_rosters")
+    export_download_button("Export Events", 'events', export_format, key="export_events")
+
+    # Keys include the row position: older versions could give two events the same EventID
+    for position, (_, event) in enumerate(events.iterrows()):
+        with st.expander(f"{event['Event Name']} on {format_date(event['Date'])}"):
+            main_list_users = rosters.get((event['EventID'], 'Registered'))
+            reserve_list_users = rosters.get((event['EventID'], 'Reserve'))
+            if main_list_users is not None or reserve_list_users is not None:
+                export_download_button("Export Roster", 'rosters', export_format, key=f"export_roster_{position}_{event['EventID']}", event_id=event['EventID'])
+
+            if main_list_users is not None:
+                st.write("**Main List**")
+                st.write(main_list_users)
+
+            if reserve_list_users is not None:
+                st.write("**Reserve List**")
+                st.write(reserve_list_users)
+
+# Remove events and edit capacities
+def admin_remove_event():
+    st.subheader("Remove Event ❌")
+    events = load_data(EVENT_DATA_FILE, ['EventID', 'Event Name', 'Max Volunteers', 'Reserve Capacity'])
+    event_to_remove = st.selectbox("Select Event to Remove", events['Event Name'])
+    if st.button("Remove Event"):
+        event_id = events[events['Event Name'] == event_to_remove]['EventID'].values[0]
+        remove_event(event_id)
+        st.success("Event removed successfully! ❌")
+
+    st.subheader("Edit Capacities ✏️")
+    capacity_columns = ['Max Volunteers', 'Reserve Capacity']
+    edited = st.data_editor(
+        events,
+        disabled=['EventID', 'Event Name'],
+        column_config={column: st.column_config.NumberColumn(column, required=True, min_value=1, step=1) for column in capacity_columns},
+        hide_index=True,
+        key="capacity_editor"
+    )
+    if st.button("Save Capacities"):
+        before, after = events[capacity_columns], edited[capacity_columns]
+        changed = edited[((before.isna() != after.isna()) | (before != after).fillna(False)).any(axis=1)]
+        # A cleared cell comes back as NA
+        if changed[capacity_columns].isna().any(axis=None) or (changed[capacity_columns] < 1).any(axis=None):
+            st.error("Capacities must be whole numbers of at least 1.")
+            return
+        promoted = update_event_capacities({
+            row['EventID']: (int(row['Max Volunteers']), int(row['Reserve Capacity'])) for _, row in changed.iterrows()
+        })
+        st.success(f"Capacities updated! {promoted} reserve registrations moved to the main list.")
+
+# All users
+USERS_PAGE_SIZE = 50
+
+def admin_all_users():
+    st.subheader("All Users 👥")
+    search = st.text_input("Search by the start of a name, username or Telegram ID", key="users_search")
+    sort_column, order_column = st.columns(2)
+    order = sort_column.selectbox("Sort by", ['ID', 'Name', 'Last Name', 'Username', 'Telegram ID'], key="users_order")
+    descending = order_column.checkbox("Descending", key="users_descending")
+    total = count_users(search)
+    st.write(f"{total} users")
+    if total:
+        offset = page_offset(total, USERS_PAGE_SIZE, key="users_page")
+        users = search_users(search, order, descending, offset, USERS_PAGE_SIZE)
         st.write(users[['ID', 'Name', 'Last Name', 'Mobile Number', 'Telegram ID', 'Username', 'Password']])
 
-    # User Messages tab
-    # User Messages tab
-    with tabs[4]:
-        st.subheader("User Messages ✉️")
-
-        messages = load_data(CONTACT_DATA_FILE)  # Ensure messages are loaded from CONTACT_DATA_FILE
-        users = load_data(USER_DATA_FILE)
-
-        if not messages.empty:
-            user_ids = messages['UserID'].unique()
-            user_dict = {user_id: users[users['ID'] == user_id].iloc[0]['Username'] for user_id in user_ids}
-            selected_user = st.selectbox("Select User", options=list(user_dict.keys()), format_func=lambda x: user_dict[x])
-
-            user_messages = messages[messages['UserID'] == selected_user]
-            for index, message in user_messages.iterrows():
-                user_info = users[users['ID'] == selected_user].iloc[0]
-                st.write(f"**From:** {user_info['Name']} {user_info['Last Name']} ({user_info['Username']})")
-                st.write(f"**Subject:** {message['Subject']}")
-                st.write(f"**Message:** {message['Message']}")
-                response = st.text_area(f"Response to {user_info['Username']}:", key=f"response_{message['UserID']}_{index}")
-                if st.button("Send Response", key=f"send_{message['UserID']}_{index}"):
-                    if response:
-                        # Update the DataFrame with the response
-                        messages.at[index, 'Response'] = response
-                        save_data(CONTACT_DATA_FILE, messages)  # Save back to CONTACT_DATA_FILE
-                        st.success("Response sent successfully!")
-                    else:
-                        st.warning("Response cannot be empty.")
-                st.write("---")
-        else:
-            st.write("No messages from users.")
-
-    # File Exchange tab
-    with tabs[5]:
-        st.subheader("File Exchange📂")
-        
-        st.write("**Files from Users**")
-        files = load_data(FILES_DATA_FILE)
-        users = load_data(USER_DATA_FILE)
-        
-        user_files = files[files['FromAdmin'] == 'False']
-        if not user_files.empty:
-            user_ids = user_files['UserID'].unique()
-            user_dict = {user_id: users[users['ID'] == user_id].iloc[0]['Username'] for user_id in user_ids}
-            selected_user = st.selectbox("Select User", options=list(user_dict.keys()), format_func=lambda x: user_dict[x])
-            
-            user_files_selected = user_files[user_files['UserID'] == selected_user]
-            for index, file in user_files_selected.iterrows():
-                st.write(f"**Filename:** {file['Filename']}")
-                st.download_button(
-                    "Download", 
-                    data=BytesIO(bytes(eval(file['FileData']))), 
-                    file_name=file['Filename'],
-                    key=f"download_user_{index}"  # Unique key for each button
-                )
-        else:
-            st.write("No files from users.")
-        
-        st.write("**Upload File for Users**")
-        uploaded_file = st.file_uploader("Choose a file")
-        if uploaded_file is not None:
-            user_options = users['Username'].tolist()
-            user_to_send = st.selectbox("Select User to Send", user_options)
-            if st.button("Upload and Send"):
-                user_id_to_send = users[users['Username'] == user_to_send].iloc[0]['ID']
-                file_data = uploaded_file.getvalue()
-                new_file = {
-                    'UserID': user_id_to_send,
-                    'Filename': uploaded_file.name,
-                    'FileData': str(list(file_data)),
-                    'FromAdmin': 'True'
-                }
-                files = pd.concat([files, pd.DataFrame([new_file])], ignore_index=True)
-                save_data(FILES_DATA_FILE, files)
-                st.success("File sent successfully!")
-    # User panel
-# User panel
-def user_panel():
-    st.title("User Panel 🎨")
+# Messages from users
+# Inbox: threads (one per sender) with unread messages come first and only unread messages are
+# loaded up front; a thread's answered messages are loaded MESSAGES_PAGE_SIZE at a time
+MESSAGES_PAGE_SIZE = 10
+
+def load_more(key, step):
+    st.session_state[key] = st.session_state.get(key, 0) + step
+
+def admin_messages():
+    st.subheader("User Messages ✉️")
+
+    unread = find_data(CONTACT_DATA_FILE, {'Status': 'unread'}).sort_values('MessageID')
+    user_map = get_user_map()
+    unread_counts = unread['UserID'].value_counts().to_dict()
+    user_ids = [user_id for user_id in unread['UserID'].unique() if user_id in user_map]
+    if st.checkbox("Show answered threads", key="messages_all"):
+        senders = load_data(CONTACT_DATA_FILE, ['UserID'])['UserID'].unique()
+        user_ids += [user_id for user_id in senders if user_id in user_map and user_id not in unread_counts]
+
+    if not user_ids:
+        st.write("No unread messages.")
+        return
+
+    selected_user = st.selectbox("Select User", options=user_ids, format_func=lambda x: f"{user_map[x]['Username']} ({unread_counts.get(x, 0)} unread)", key="messages_user")
+    user_info = user_map.get(selected_user)
+    for _, message in unread[unread['UserID'] == selected_user].iterrows():
+        st.write(f"**From:** {user_info['Name']} {user_info['Last Name']} ({user_info['Username']})")
+        st.write(f"**Subject:** {message['Subject']}")
+        st.write(f"**Message:** {message['Message']}")
+        response = st.text_area(f"Response to {user_info['Username']}:", key=f"response_{message['MessageID']}")
+        if st.button("Send Response", key=f"send_{message['MessageID']}"):
+            if response:
+                respond_to_message(message['MessageID'], response)
+                st.success("Response sent successfully!")
+            else:
+                st.warning("Response cannot be empty.")
+        st.write("---")
+
+    older_key = f"messages_older_{selected_user}"
+    shown = st.session_state.get(older_key, 0)
+    if shown:
+        answered = find_data(CONTACT_DATA_FILE, {'UserID': selected_user, 'Status': 'answered'})
+        answered = answered.sort_values('MessageID', ascending=False)
+        for _, message in answered.head(shown).iterrows():
+            st.write(f"**Subject:** {message['Subject']}")
+            st.write(f"**Message:** {message['Message']}")
+            st.write(f"**Response:** {message['Response']}")
+            st.write("---")
+        if len(answered) <= shown:
+            return
+    st.button("Load older messages", key=f"load_{older_key}", on_click=load_more, args=(older_key, MESSAGES_PAGE_SIZE))
+
+# Files from and for users
+def admin_files():
+    st.subheader("File Exchange📂")
+
+    st.write("**Files from Users**")
+    files = load_data(FILES_DATA_FILE)
+    user_map = get_user_map()
+
+    user_files = files[~files['FromAdmin']]
+    if not user_files.empty:
+        user_ids = [user_id for user_id in user_files['UserID'].unique() if user_id in user_map]
+        selected_user = st.selectbox("Select User", options=user_ids, format_func=lambda x: user_map[x]['Username'], key="files_user")
+
+        user_files_selected = user_files[user_files['UserID'] == selected_user]
+        for index, file in user_files_selected.iterrows():
+            st.write(f"**Filename:** {file['Filename']}")
+            lazy_download_button(file, key=f"download_user_{index}")  # Unique key for each button
+    else:
+        st.write("No files from users.")
+
+    st.write("**Upload File for Users**")
+    uploaded_file = st.file_uploader("Choose a file")
+    if uploaded_file is not None:
+        user_options = [user['Username'] for user in user_map.values()]
+        user_to_send = st.selectbox("Select User to Send", user_options)
+        if st.button("Upload and Send"):
+            user_id_to_send = get_user_id(user_to_send)
+            save_upload(user_id_to_send, uploaded_file.name, uploaded_file, from_admin=True)
+            st.success("File sent successfully!")
+
+# Admin panel: only the selected view loads its data and renders
+ADMIN_VIEWS = {
+    "Create Event 🎉": admin_create_event,
+    "View Registered Users 📋": admin_rosters,
+    "Remove Event ❌": admin_remove_event,
+    "View All Users 👥": admin_all_users,
+    "User Messages ✉️": admin_messages,
+    "File Exchange 📂": admin_files,
+}
 
-    tabs = st.tabs(["View Events 📅", "My Registrations 🗂️", "Messages From Admin ✉️", "Contact Admin 📧", "File Exchange 📂"])
-
-    # View Events tab
-    with tabs[0]:
-        st.subheader("Events 📅")
-        events = load_data(EVENT_DATA_FILE)
-        registrations = load_data(REGISTRATION_DATA_FILE)
-        users = load_data(USER_DATA_FILE)
-        user_id = users[users['Username'] == st.session_state['username']]['ID'].values[0]
-
-        for _, event in events.iterrows():
-            with st.expander(f"{event['Event Name']} on {event['Date']}"):
-                st.write(f"**Time:** {event['Time']}")
-                st.write(f"**Day:** {event['Day']}")
-                st.write(f"**Location:** {event['Location']}")
-                st.write(f"**Description:** {event['Description']}")
-                st.write(f"**Max Volunteers:** {event['Max Volunteers']}")
-                st.write(f"**Reserve Capacity:** {event['Reserve Capacity']}")
-
-                registered_users = registrations[(registrations['EventID'] == str(event['EventID'])) & (registrations['Status'] == 'Registered')]
-                reserve_users = registrations[(registrations['EventID'] == str(event['EventID'])) & (registrations['Status'] == 'Reserve')]
-
-                if user_id in registered_users['UserID'].values:
-                    st.write("You are registered for this event.")
-                elif user_id in reserve_users['UserID'].values:
-                    st.write("You are on the reserve list for this event.")
+def admin_panel():
+    st.title("Admin Panel 🛠️")
+
+    view = st.radio("View", list(ADMIN_VIEWS), horizontal=True, key="admin_view", label_visibility="collapsed")
+    ADMIN_VIEWS[view]()
+
+# Event list with registration buttons
+EVENTS_PAGE_SIZE = 10
+
+def user_events():
+    st.subheader("Events 📅")
+    when = st.radio("Show", ["Upcoming", "Past"], horizontal=True, key="events_when")
+    search = st.text_input("Search events", key="events_search")
+    events = filter_events(load_data(EVENT_DATA_FILE), when, search)
+    if events.empty:
+        st.write("No events found.")
+        return
+    events = paginate(events, EVENTS_PAGE_SIZE, key="events_page")
+
+    # Counts only for the events on this page
+    registrations = load_data(REGISTRATION_DATA_FILE, ['UserID', 'EventID', 'Status'])
+    registrations = registrations[registrations['EventID'].isin(events['EventID'])]
+    user_id = get_user_id(st.session_state['username'])
+    counts, user_status = registration_summary(registrations, user_id)
+
+    for _, event in events.iterrows():
+        event_id = event['EventID']
+        with st.expander(f"{event['Event Name']} on {format_date(event['Date'])}"):
+            st.write(f"**Time:** {format_time(event['Time'])}")
+            st.write(f"**Day:** {event['Day']}")
+            st.write(f"**Location:** {event['Location']}")
+            st.write(f"**Description:** {event['Description']}")
+            st.write(f"**Max Volunteers:** {event['Max Volunteers']}")
+            st.write(f"**Reserve Capacity:** {event['Reserve Capacity']}")
+
+            registered_count = counts.get((event_id, 'Registered'), 0)
+            reserve_count = counts.get((event_id, 'Reserve'), 0)
+
+            if user_status.get(event_id) == 'Registered':
+                st.write("You are registered for this event.")
+            elif user_status.get(event_id) == 'Reserve':
+                st.write("You are on the reserve list for this event.")
+            else:
+                if registered_count < event['Max Volunteers']:
+                    button_label = f"Register for {event['Event Name']}"
+                elif reserve_count < int(event['Reserve Capacity']):  # Ensure comparison is valid
+                    button_label = f"Join Reserve List for {event['Event Name']}"
                 else:
-                    if len(registered_users) < event['Max Volunteers']:
-                        if st.button(f"Register for {event['Event Name']}"):
-                            registrations = pd.concat([registrations, pd.DataFrame([{'UserID': user_id, 'EventID': str(event['EventID']), 'Status': 'Registered'}])], ignore_index=True)
-                            save_data(REGISTRATION_DATA_FILE, registrations)
-                            st.success("Registered successfully!")
-                            st.experimental_rerun()
-                    elif len(reserve_users) < int(event['Reserve Capacity']):  # Ensure comparison is valid
-                        if st.button(f"Join Reserve List for {event['Event Name']}"):
-                            registrations = pd.concat([registrations, pd.DataFrame([{'UserID': user_id, 'EventID': str(event['EventID']), 'Status': 'Reserve'}])], ignore_index=True)
-                            save_data(REGISTRATION_DATA_FILE, registrations)
-                            st.success("Added to reserve list!")
-                            st.experimental_rerun()
+                    button_label = None
+                    st.write("Event is full.")
+
+                # The counts above are only a hint; register_for_event re-checks capacity atomically
+                if button_label and st.button(button_label):
+                    status = register_for_event(user_id, event_id)
+                    if status == 'Full':
+                        st.error("Event is full.")
+                    elif status == 'Missing':
+                        st.error("This event is no longer available.")
                     else:
-                        st.write("Event is full.")
-
-    # My Registrations tab
-    with tabs[1]:
-        st.subheader("My Registrations 🗂️")
-        registrations = load_data(REGISTRATION_DATA_FILE)
-        events = load_data(EVENT_DATA_FILE)
-        users = load_data(USER_DATA_FILE)
-        user_id = users[users['Username'] == st.session_state['username']].iloc[0]['ID']
-
-        user_registrations = registrations[registrations['UserID'] == user_id]
-
-        if not user_registrations.empty:
-            for _, reg in user_registrations.iterrows():
-                event_info = events[events['EventID'] == reg['EventID']]
-                if not event_info.empty:
-                    event_info = event_info.iloc[0]
-                    with st.expander(f"{event_info['Event Name']} on {event_info['Date']}"):
-                        st.write(f"**Event:** {event_info['Event Name']}")
-                        st.write(f"**Date:** {event_info['Date']}")
-                        st.write(f"**Time:** {event_info['Time']}")
-                        st.write(f"**Day:** {event_info['Day']}")
-                        st.write(f"**Location:** {event_info['Location']}")
-                        st.write(f"**Description:** {event_info['Description']}")
-                        st.write(f"**Status:** {reg['Status']}")
-
-                        if st.button(f"Cancel Registration for {event_info['Event Name']}", key=f"cancel_{reg['EventID']}"):
-                            # Remove registration
-                            registrations = registrations.drop(reg.name)
-
-                            # Move the first person from the reserve list to registered list if main list is full
-                            event_registrations = registrations[registrations['EventID'] == reg['EventID']]
-                            main_list_count = len(event_registrations[event_registrations['Status'] == 'Registered'])
-                            reserve_list = event_registrations[event_registrations['Status'] == 'Reserve']
-
-                            if main_list_count < event_info['Max Volunteers'] and not reserve_list.empty:
-                                # Move the first person from reserve to main list
-                                first_reserve = reserve_list.iloc[0]
-                                registrations.loc[first_reserve.name, 'Status'] = 'Registered'
-                                st.success("Registration canceled successfully. Replaced with first person from reserve list!")
-                            else:
-                                st.success("Registration canceled successfully.")
-
-                            save_data(REGISTRATION_DATA_FILE, registrations)
-                            st.experimental_rerun()
-        else:
-            st.write("You have no registrations.")
+                        st.success("Registered successfully!" if status == 'Registered' else "Added to reserve list!")
+                        st.experimental_rerun()
+
+# The user's registrations
+def user_registrations():
+    st.subheader("My Registrations 🗂️")
+    user_id = get_user_id(st.session_state['username'])
+
+    user_registrations = find_data(REGISTRATION_DATA_FILE, {'UserID': user_id})
+
+    if not user_registrations.empty:
+        for _, reg in user_registrations.iterrows():
+            event_info = find_data(EVENT_DATA_FILE, {'EventID': reg['EventID']})
+            if not event_info.empty:
+                event_info = event_info.iloc[0]
+                with st.expander(f"{event_info['Event Name']} on {format_date(event_info['Date'])}"):
+                    st.write(f"**Event:** {event_info['Event Name']}")
+                    st.write(f"**Date:** {format_date(event_info['Date'])}")
+                    st.write(f"**Time:** {format_time(event_info['Time'])}")
+                    st.write(f"**Day:** {event_info['Day']}")
+                    st.write(f"**Location:** {event_info['Location']}")
+                    st.write(f"**Description:** {event_info['Description']}")
+                    st.write(f"**Status:** {reg['Status']}")
+
+                    if st.button(f"Cancel Registration for {event_info['Event Name']}", key=f"cancel_{reg['EventID']}"):
+                        # Remove registration and move the first person from the reserve list to the main list
+                        if cancel_registration(user_id, reg['EventID']) is not None:
+                            st.success("Registration canceled successfully. Replaced with first person from reserve list!")
+                        else:
+                            st.success("Registration canceled successfully.")
+
+                        st.experimental_rerun()
+    else:
+        st.write("You have no registrations.")
 
+# Messages and admin responses
+def user_messages():
+    st.subheader("Messages ✉️")
+    user_id = get_user_id(st.session_state['username'])
 
-    # Messages tab
-        # Messages tab
-    with tabs[2]:
-        st.subheader("Messages ✉️")
-        messages = load_data(CONTACT_DATA_FILE)  # Ensure messages are loaded from CONTACT_DATA_FILE
-        users = load_data(USER_DATA_FILE)
-        user_id = users[users['Username'] == st.session_state['username']]['ID'].values[0]
+    user_messages = find_data(CONTACT_DATA_FILE, {'UserID': user_id})
 
-        user_messages = messages[messages['UserID'] == user_id]
+    if not user_messages.empty:
+        for _, message in user_messages.iterrows():
+            st.write(f"**Subject:** {message['Subject']}")
+            st.write(f"**Message:** {message['Message']}")
+            st.write(f"**Response:** {message['Response']}")  # Display the response
+    else:
+        st.write("No messages.")
+
+# Contact the admin
+def user_contact():
+    st.subheader("Contact Admin 📧")
+    admin_telegram_id = "Amin18"
+    telegram_url = f"https://t.me/{admin_telegram_id}"
+
+    # Add a button to navigate to Telegram
+    st.write("If you need help, please contact the admin on Telegram.")
+
+    # Use HTML for the button to navigate to Telegram
+    telegram_button_html = f'''
+    <a href="{telegram_url}" target="_blank">
+        <button style="background-color: #0088cc; color: white; padding: 10px 20px; border: none; border-radius: 5px; cursor: pointer;">
+            Message Admin on Telegram
+        </button>
+    </a>
+    '''
+    st.markdown(telegram_button_html, unsafe_allow_html=True)
+    st.write(" ")
+    st.write(" ")
+    st.write(" Or contact admin with form")
+
+    with st.form(key='contact_admin_form'):
+        subject = st.text_input("Subject", key="contact_subject")
+        message = st.text_area("Message", key="contact_message")
+
+        submit_button = st.form_submit_button(label='Send Message')
 
-        if not user_messages.empty:
-            for _, message in user_messages.iterrows():
-                st.write(f"**Subject:** {message['Subject']}")
-                st.write(f"**Message:** {message['Message']}")
-                st.write(f"**Response:** {message['Response']}")  # Display the response
-        else:
-            st.write("No messages.")
-
-
-    # Contact Admin tab
-    # Contact Admin tab
-    with tabs[3]:
-        st.subheader("Contact Admin 📧")
-        admin_telegram_id = "Amin18"
-        telegram_url = f"https://t.me/{admin_telegram_id}"
-
-        # Add a button to navigate to Telegram
-        st.write("If you need help, please contact the admin on Telegram.")
-        
-        # Use HTML for the button to navigate to Telegram
-        telegram_button_html = f'''
-        <a href="{telegram_url}" target="_blank">
-            <button style="background-color: #0088cc; color: white; padding: 10px 20px; border: none; border-radius: 5px; cursor: pointer;">
-                Message Admin on Telegram
-            </button>
-        </a>
-        '''
-        st.markdown(telegram_button_html, unsafe_allow_html=True)
-        st.write(" ")
-        st.write(" ")
-        st.write(" Or contact admin with form")
-
-        with st.form(key='contact_admin_form'):
-            subject = st.text_input("Subject", key="contact_subject")
-            message = st.text_area("Message", key="contact_message")
-
-            submit_button = st.form_submit_button(label='Send Message')
-
-        if submit_button:
-            if subject and message:
-                messages = load_data(CONTACT_DATA_FILE)  # Ensure messages are loaded from CONTACT_DATA_FILE
-                user_id = users[users['Username'] == st.session_state['username']]['ID'].values[0]
-                message_data = {
-                    'UserID': user_id,
-                    'Subject': subject,
-                    'Message': message,
-                    'Response': ''  # Initialize with empty response
-                }
-                save_data(CONTACT_DATA_FILE, pd.concat([messages, pd.DataFrame([message_data])], ignore_index=True))  # Save to CONTACT_DATA_FILE
-                st.success("Message sent to admin!")
-            else:
-                st.error("Please fill out all fields.")
-    # File Exchange tab
-    with tabs[4]:
-        st.subheader("File Exchange")
-        
-        st.write("**Files from Admin**")
-        files = load_data(FILES_DATA_FILE)
-        users = load_data(USER_DATA_FILE)
-        user_id = users[users['Username'] == st.session_state['username']].iloc[0]['ID']
-        
-        admin_files = files[(files['UserID'] == user_id) & (files['FromAdmin'] == 'True')]
-        if not admin_files.empty:
-            filenames = admin_files['Filename'].tolist()
-            selected_file = st.selectbox("Select File", filenames)
-            file_selected = admin_files[admin_files['Filename'] == selected_file].iloc[0]
-            st.download_button(
-                "Download", 
-                data=BytesIO(bytes(eval(file_selected['FileData']))), 
-                file_name=file_selected['Filename'],
-                key=f"download_admin_{file_selected.name}"  # Unique key for each button
-            )
+    if submit_button:
+        if subject and message:
+            send_contact_message(get_user_id(st.session_state['username']), subject, message)
+            st.success("Message sent to admin!")
         else:
-            st.write("No files from admin.")
-        
-        st.write("**Upload File for Admin**")
-        uploaded_file = st.file_uploader("Choose a file")
-        if uploaded_file is not None:
-            if st.button("Upload and Send to Admin"):
-                file_data = uploaded_file.getvalue()
-                new_file = {
-                    'UserID': user_id,
-                    'Filename': uploaded_file.name,
-                    'FileData': str(list(file_data)),
-                    'FromAdmin': 'False'
-                }
-                files = pd.concat([files, pd.DataFrame([new_file])], ignore_index=True)
-                save_data(FILES_DATA_FILE, files)
-                st.success("File sent successfully!")
+            st.error("Please fill out all fields.")
+
+# Files from and for the admin
+def user_files():
+    st.subheader("File Exchange")
+
+    st.write("**Files from Admin**")
+    user_id = get_user_id(st.session_state['username'])
+
+    admin_files = find_data(FILES_DATA_FILE, {'UserID': user_id, 'FromAdmin': True})
+    if not admin_files.empty:
+        filenames = admin_files['Filename'].tolist()
+        selected_file = st.selectbox("Select File", filenames)
+        file_selected = admin_files[admin_files['Filename'] == selected_file].iloc[0]
+        lazy_download_button(file_selected, key=f"download_admin_{file_selected.name}")  # Unique key for each button
+    else:
+        st.write("No files from admin.")
+
+    st.write("**Upload File for Admin**")
+    uploaded_file = st.file_uploader("Choose a file")
+    if uploaded_file is not None:
+        if st.button("Upload and Send to Admin"):
+            save_upload(user_id, uploaded_file.name, uploaded_file, from_admin=False)
+            st.success("File sent successfully!")
+
+# User panel: only the selected view loads its data and renders
+USER_VIEWS = {
+    "View Events 📅": user_events,
+    "My Registrations 🗂️": user_registrations,
+    "Messages From Admin ✉️": user_messages,
+    "Contact Admin 📧": user_contact,
+    "File Exchange 📂": user_files,
+}
+
+def user_panel():
+    st.title("User Panel 🎨")
+
+    view = st.radio("View", list(USER_VIEWS), horizontal=True, key="user_view", label_visibility="collapsed")
+    USER_VIEWS[view]()
 
 
 # Main function to
 def main():
     st.set_page_config(page_title="Events and Games", page_icon="🌟")
+    upgrade_tables()
+    migrate_file_blobs()
+    migrate_message_ids()
 
     # Custom CSS to style elements
     st.markdown(
@@ -585,4 +615,7 @@ def main():
             logout()
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:] == ['migrate', 'feather']:
+        migrate_to_feather()
+    else:
+        main()
@@ -0,0 +1,102 @@
+# Registration engine check: PROCESSES app processes with THREADS threads each register users
+# for one event at the same time, then cancel some of the main list places at the same time.
+# The event must be filled exactly (no overbooking, no lost places) and every cancellation must
+# promote the head of the waitlist. Each backend runs in a fresh temporary data directory.
+#
+#   python scripts/check_registration_concurrency.py [csv] [sqlite] [feather]
+import collections
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKENDS = ['csv', 'sqlite', 'feather']
+
+PROCESSES = 3
+THREADS = 50
+USERS_PER_PROCESS = 150
+CANCELS_PER_PROCESS = 10
+EVENT_ID = 1
+MAX_VOLUNTEERS = 100
+RESERVE_CAPACITY = 50
+
+def worker_users(index):
+    return range(index * USERS_PER_PROCESS + 1, (index + 1) * USERS_PER_PROCESS + 1)
+
+# Runs in a worker process, inside the temporary data directory
+def run_worker(phase, index):
+    sys.path.insert(0, REPO_DIR)
+    import events_store as app
+    if phase == 'setup':
+        app.append_data(app.EVENT_DATA_FILE, {
+            'EventID': EVENT_ID, 'Event Name': 'Check', 'Date': '2030-01-01', 'Time': '10:00', 'Day': 'Tuesday',
+            'Location': '-', 'Description': '-', 'Max Volunteers': MAX_VOLUNTEERS, 'Reserve Capacity': RESERVE_CAPACITY
+        })
+        result = None
+    elif phase == 'register':
+        with ThreadPoolExecutor(THREADS) as pool:
+            result = list(pool.map(lambda user_id: app.register_for_event(user_id, EVENT_ID), worker_users(index)))
+    elif phase == 'cancel':
+        registrations = app.load_data(app.REGISTRATION_DATA_FILE)
+        registered = registrations[(registrations['Status'] == 'Registered') & registrations['UserID'].isin(worker_users(index))]
+        cancelled = [int(user_id) for user_id in registered['UserID'].head(CANCELS_PER_PROCESS)]
+        with ThreadPoolExecutor(THREADS) as pool:
+            result = [promoted is not None for promoted in pool.map(lambda user_id: app.cancel_registration(user_id, EVENT_ID), cancelled)]
+    else:
+        registrations = app.load_data(app.REGISTRATION_DATA_FILE)
+        result = {
+            'statuses': registrations['Status'].astype(str).value_counts().to_dict(),
+            'duplicates': int(registrations.duplicated(['UserID', 'EventID']).sum()),
+        }
+    print(json.dumps(result))
+
+# Start `count` worker processes for `phase` at once and collect their results
+def run_phase(data_dir, backend, phase, count=1):
+    env = dict(os.environ, STORAGE_BACKEND=backend)
+    processes = [
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker', phase, str(index)], cwd=data_dir, env=env, stdout=subprocess.PIPE, text=True)
+        for index in range(count)
+    ]
+    results = []
+    for process in processes:
+        output, _ = process.communicate()
+        if process.returncode != 0:
+            raise SystemExit(f"{backend}: {phase} worker failed")
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return results
+
+def check_backend(backend):
+    failures = []
+    with tempfile.TemporaryDirectory() as data_dir:
+        run_phase(data_dir, backend, 'setup')
+        returned = collections.Counter(status for statuses in run_phase(data_dir, backend, 'register', PROCESSES) for status in statuses)
+        expected = {'Registered': MAX_VOLUNTEERS, 'Reserve': RESERVE_CAPACITY, 'Full': PROCESSES * USERS_PER_PROCESS - MAX_VOLUNTEERS - RESERVE_CAPACITY}
+        if dict(returned) != expected:
+            failures.append(f"register returned {dict(returned)}, expected {expected}")
+        cancelled = [promoted for results in run_phase(data_dir, backend, 'cancel', PROCESSES) for promoted in results]
+        if not all(cancelled):
+            failures.append(f"{cancelled.count(False)} of {len(cancelled)} cancellations promoted nobody")
+        stored = run_phase(data_dir, backend, 'verify')[0]
+        expected = {'Registered': MAX_VOLUNTEERS, 'Reserve': RESERVE_CAPACITY - len(cancelled)}
+        if stored['statuses'] != expected:
+            failures.append(f"stored {stored['statuses']}, expected {expected}")
+        if stored['duplicates']:
+            failures.append(f"{stored['duplicates']} duplicate registrations")
+    return failures
+
+def main(backends):
+    ok = True
+    for backend in backends:
+        failures = check_backend(backend)
+        print(f"{backend}: {'ok' if not failures else '; '.join(failures)}")
+        ok = ok and not failures
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--worker']:
+        run_worker(sys.argv[2], int(sys.argv[3]))
+    else:
+        sys.exit(main(sys.argv[1:] or BACKENDS))
@@ -0,0 +1,85 @@
+# Roster export check: registrations for two events, stored in an order that differs from both
+# the user IDs and the join times, with both statuses on each event and a registration whose
+# user was deleted. The export must list each event's main list and then its waitlist in join
+# order, and leave out the orphaned row. Each backend runs in a fresh temporary data directory.
+#
+#   python scripts/check_roster_export.py [csv] [sqlite] [feather]
+import csv
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKENDS = ['csv', 'sqlite', 'feather']
+
+USER_IDS = [1, 2, 3, 4, 5, 6]
+# (UserID, EventID, Status, Joined At), in stored order; user 9 does not exist
+REGISTRATIONS = [
+    (6, 2, 'Reserve', '2030-01-01T10:00:05'),
+    (3, 1, 'Reserve', '2030-01-01T10:00:04'),
+    (5, 1, 'Registered', '2030-01-01T10:00:01'),
+    (1, 2, 'Registered', '2030-01-01T10:00:03'),
+    (2, 1, 'Reserve', '2030-01-01T10:00:02'),
+    (9, 1, 'Registered', '2030-01-01T10:00:00'),
+    (4, 1, 'Registered', '2030-01-01T10:00:06'),
+    (2, 2, 'Reserve', '2030-01-01T10:00:01'),
+    (3, 2, 'Registered', '2030-01-01T10:00:00'),
+]
+EXPECTED = [
+    ('1', 'Registered', '5'), ('1', 'Registered', '4'), ('1', 'Reserve', '2'), ('1', 'Reserve', '3'),
+    ('2', 'Registered', '3'), ('2', 'Registered', '1'), ('2', 'Reserve', '2'), ('2', 'Reserve', '6'),
+]
+
+# Runs in a worker process, inside the temporary data directory
+def run_worker():
+    sys.path.insert(0, REPO_DIR)
+    import events_store as app
+    for user_id in USER_IDS:
+        app.append_data(app.USER_DATA_FILE, {'ID': user_id, 'Name': f"N{user_id}", 'Last Name': f"L{user_id}", 'Username': f"u{user_id}", 'Password': 'x'})
+    for event_id in (1, 2):
+        app.append_data(app.EVENT_DATA_FILE, {
+            'EventID': event_id, 'Event Name': f"E{event_id}", 'Date': '2030-01-01', 'Time': '10:00', 'Day': 'Tuesday',
+            'Location': '-', 'Description': '-', 'Max Volunteers': 2, 'Reserve Capacity': 2
+        })
+    for user_id, event_id, status, joined_at in REGISTRATIONS:
+        app.append_data(app.REGISTRATION_DATA_FILE, {'UserID': user_id, 'EventID': event_id, 'Status': status, 'Joined At': joined_at})
+    result = {}
+    for export_format in ('csv', 'xlsx'):
+        path = app.build_export('rosters', export_format)
+        if export_format == 'csv':
+            with open(path, newline='', encoding='utf-8') as f:
+                rows = [(row['EventID'], row['Status'], row['UserID']) for row in csv.DictReader(f)]
+        else:
+            sheet = app.openpyxl.load_workbook(path, read_only=True).active
+            header, *values = sheet.iter_rows(values_only=True)
+            rows = [tuple(str(row[header.index(column)]) for column in ('EventID', 'Status', 'UserID')) for row in values]
+        result[export_format] = rows
+    print(json.dumps(result))
+
+def check_backend(backend):
+    with tempfile.TemporaryDirectory() as data_dir:
+        env = dict(os.environ, STORAGE_BACKEND=backend)
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker'], cwd=data_dir, env=env, stdout=subprocess.PIPE, text=True)
+        if process.returncode != 0:
+            return ["worker failed"]
+        result = json.loads(process.stdout.strip().splitlines()[-1])
+    return [
+        f"{export_format} rows {[tuple(row) for row in rows]}, expected {EXPECTED}"
+        for export_format, rows in result.items() if [tuple(row) for row in rows] != EXPECTED
+    ]
+
+def main(backends):
+    ok = True
+    for backend in backends:
+        failures = check_backend(backend)
+        print(f"{backend}: {'ok' if not failures else '; '.join(failures)}")
+        ok = ok and not failures
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--worker']:
+        run_worker()
+    else:
+        sys.exit(main(sys.argv[1:] or BACKENDS))
@@ -0,0 +1,255 @@
+# Telegram bot check against a fake Bot API server: USERS users each sign up, log in and register
+# for one event (MAX_VOLUNTEERS places, RESERVE_CAPACITY on the waitlist). Every user's updates
+# are sent at once, step by step across all users, with no pause for the bot's replies, so the
+# bot must keep each chat's updates in order. Every user must get a registration answer and the
+# event must be filled exactly.
+#
+# Two more chats run alongside: a slow chat sends SLOW_UPDATES updates up front and each reply to
+# it takes SLOW_REPLY_SECONDS, so the users must all be done while it is still busy (its waiting
+# updates must not take the bot's CONCURRENT_UPDATES slots); and every reply to a broken chat
+# fails, which must be the only handler error and, in webhook mode, the only failed update.
+# Each mode runs in a fresh temporary data directory, with the backend from STORAGE_BACKEND.
+#
+#   python scripts/check_telegram_bot.py [polling] [webhook]
+import asyncio
+import collections
+import itertools
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = ['polling', 'webhook']
+
+USERS = 40
+EVENT_ID = 1
+MAX_VOLUNTEERS = 20
+RESERVE_CAPACITY = 10
+SLOW_CHAT = 9001
+SLOW_UPDATES = 30
+SLOW_REPLY_SECONDS = 0.2
+BROKEN_CHAT = 9002
+CONCURRENT_UPDATES = 4
+TIMEOUT = 120
+TOKEN = 'CHECK'
+WEBHOOK_SECRET = 'check-secret'
+
+ids = itertools.count(1000)
+sent = []
+bot_user = {'id': 1, 'is_bot': True, 'first_name': 'Bot', 'username': 'check_bot'}
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def fake_api_app():
+    import tornado.web
+
+    # Bot API methods the bot calls; every call is recorded in `sent` when it is answered
+    class FakeApiHandler(tornado.web.RequestHandler):
+        async def post(self, token, method):
+            if 'json' in self.request.headers.get('Content-Type', ''):
+                params = json.loads(self.request.body or b'{}')
+            else:
+                params = {key: self.get_body_argument(key) for key in self.request.body_arguments}
+            if str(params.get('chat_id')) == str(SLOW_CHAT):
+                await asyncio.sleep(SLOW_REPLY_SECONDS)
+            sent.append((method, params))
+            if str(params.get('chat_id')) == str(BROKEN_CHAT):
+                self.set_status(400)
+                self.write(json.dumps({'ok': False, 'error_code': 400, 'description': 'Bad Request: chat not found'}))
+                return
+            if method == 'getMe':
+                result = bot_user
+            elif method == 'getUpdates':
+                result = []
+            elif method in ('sendMessage', 'editMessageText'):
+                result = {
+                    'message_id': next(ids), 'date': int(time.time()), 'from': bot_user, 'text': params.get('text', ''),
+                    'chat': {'id': int(params.get('chat_id') or 1), 'type': 'private'}
+                }
+            else:
+                result = True
+            self.set_header('Content-Type', 'application/json')
+            self.write(json.dumps({'ok': True, 'result': result}))
+
+    return tornado.web.Application([(r'/bot([^/]+)/(\w+)', FakeApiHandler)])
+
+def message(user_id, text):
+    data = {
+        'message_id': next(ids), 'date': int(time.time()), 'text': text,
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'U', 'username': f"tg{user_id}"}
+    }
+    if text.startswith('/'):
+        data['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+    return {'update_id': next(ids), 'message': data}
+
+def callback(user_id, data):
+    return {'update_id': next(ids), 'callback_query': {
+        'id': str(next(ids)), 'from': {'id': user_id, 'is_bot': False, 'first_name': 'U'}, 'chat_instance': 'c', 'data': data,
+        'message': {'message_id': next(ids), 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'}, 'text': 'Event'}
+    }}
+
+# One user's updates, from /start to the registration button
+def user_updates(user_id):
+    texts = ['/start', 'Sign Up', f"N{user_id}", 'L', '/skip', f"user{user_id}", 'pw', 'Login', f"user{user_id}", 'pw']
+    return [message(user_id, text) for text in texts] + [callback(user_id, f"register:{EVENT_ID}")]
+
+# The updates sent before the users' first step
+def other_chat_updates():
+    return [message(SLOW_CHAT, '/start') for _ in range(SLOW_UPDATES)] + [message(BROKEN_CHAT, '/start')]
+
+def answers():
+    return [params.get('text') for method, params in sent if method == 'answerCallbackQuery']
+
+def slow_chat_replies():
+    return sum(1 for method, params in sent if method == 'sendMessage' and str(params.get('chat_id')) == str(SLOW_CHAT))
+
+# Until every user has an answer, then until the slow chat is done; returns the slow chat's
+# replies at the moment the users were done
+async def wait_for_answers():
+    deadline = time.monotonic() + TIMEOUT
+    while len(answers()) < USERS and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    slow_replies = slow_chat_replies()
+    while slow_chat_replies() < SLOW_UPDATES and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    return slow_replies
+
+async def check_polling(bot):
+    from telegram import Update
+    application = bot.build_application(TOKEN, base_url=f"{os.environ['FAKE_API_URL']}/bot")
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    steps = [other_chat_updates()] + list(zip(*[user_updates(user_id) for user_id in range(1, USERS + 1)]))
+    for step in steps:
+        for update in step:
+            await application.update_queue.put(Update.de_json(update, application.bot))
+    slow_replies = await wait_for_answers()
+    await application.stop()
+    await application.shutdown()
+    return {'slow_replies': slow_replies}
+
+async def check_webhook(bot):
+    from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+    application = bot.build_application(TOKEN, base_url=f"{os.environ['FAKE_API_URL']}/bot")
+    stop_event = asyncio.Event()
+    server = asyncio.create_task(bot.run_webhook(application, stop_event))
+    while not any(method == 'setWebhook' for method, _ in sent):
+        await asyncio.sleep(0.1)
+    client = AsyncHTTPClient(max_clients=USERS)
+    url = f"http://127.0.0.1:{bot.WEBHOOK_PORT}{bot.WEBHOOK_PATH}"
+
+    # Delivered like Telegram does: again after Retry-After while the queue is full
+    async def post(update):
+        while True:
+            try:
+                await client.fetch(url, method='POST', body=json.dumps(update), headers={'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET})
+                return
+            except HTTPClientError as error:
+                if error.code != 503:
+                    raise
+                await asyncio.sleep(float(error.response.headers['Retry-After']) / 10)
+
+    await asyncio.gather(*[post(update) for update in other_chat_updates()])
+    for step in zip(*[user_updates(user_id) for user_id in range(1, USERS + 1)]):
+        await asyncio.gather(*[post(update) for update in step])
+    slow_replies = await wait_for_answers()
+    metrics = json.loads((await client.fetch(f"http://127.0.0.1:{bot.WEBHOOK_METRICS_PORT}/metrics")).body)
+    stop_event.set()
+    await server
+    return {'slow_replies': slow_replies, 'failed': metrics['failed']}
+
+# Runs in a worker process, inside the temporary data directory
+def run_worker(mode):
+    sys.path.insert(0, REPO_DIR)
+    errors = []
+
+    # tornado's access log reports the (expected) 503 answers as errors
+    class ErrorLog(logging.Handler):
+        def emit(self, record):
+            if record.name != 'tornado.access':
+                errors.append(record.getMessage())
+
+    logging.getLogger().addHandler(ErrorLog(logging.ERROR))
+    import events_store as store
+    store.append_data(store.EVENT_DATA_FILE, {
+        'EventID': EVENT_ID, 'Event Name': 'Check', 'Date': '2030-01-01', 'Time': '10:00', 'Day': 'Tuesday',
+        'Location': '-', 'Description': '-', 'Max Volunteers': MAX_VOLUNTEERS, 'Reserve Capacity': RESERVE_CAPACITY
+    })
+    import telegram_bot as bot
+
+    async def main():
+        api = fake_api_app().listen(int(os.environ['FAKE_API_PORT']), address='127.0.0.1')
+        try:
+            return await (check_webhook(bot) if mode == 'webhook' else check_polling(bot))
+        finally:
+            api.stop()
+
+    result = asyncio.run(main())
+    registrations = store.load_data(store.REGISTRATION_DATA_FILE)
+    print(json.dumps(dict(
+        result,
+        answers=collections.Counter(answers()),
+        statuses=registrations['Status'].astype(str).value_counts().to_dict(),
+        users=len(store.load_data(store.USER_DATA_FILE)),
+        errors=errors,
+        all_slow_replies=slow_chat_replies(),
+    )))
+
+def check_mode(mode):
+    with tempfile.TemporaryDirectory() as data_dir:
+        api_port = free_port()
+        env = dict(
+            os.environ, FAKE_API_PORT=str(api_port), FAKE_API_URL=f"http://127.0.0.1:{api_port}",
+            WEBHOOK_URL='https://example.org/telegram', WEBHOOK_LISTEN='127.0.0.1', WEBHOOK_PORT=str(free_port()),
+            WEBHOOK_METRICS_PORT=str(free_port()), WEBHOOK_SECRET=WEBHOOK_SECRET, WEBHOOK_QUEUE_SIZE='60', WEBHOOK_WORKERS=str(CONCURRENT_UPDATES),
+            BOT_CONCURRENT_UPDATES=str(CONCURRENT_UPDATES)
+        )
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', mode], cwd=data_dir, env=env, stdout=subprocess.PIPE, text=True)
+        if process.returncode != 0:
+            return ["worker failed"]
+        result = json.loads(process.stdout.strip().splitlines()[-1])
+    failures = []
+    expected = {
+        'Registered successfully!': MAX_VOLUNTEERS, 'Added to reserve list!': RESERVE_CAPACITY,
+        'Event is full.': USERS - MAX_VOLUNTEERS - RESERVE_CAPACITY
+    }
+    if result['answers'] != expected:
+        failures.append(f"answers {result['answers']}, expected {expected}")
+    expected = {'Registered': MAX_VOLUNTEERS, 'Reserve': RESERVE_CAPACITY}
+    if result['statuses'] != expected:
+        failures.append(f"stored {result['statuses']}, expected {expected}")
+    if result['users'] != USERS:
+        failures.append(f"{result['users']} users signed up, expected {USERS}")
+    if result['slow_replies'] >= SLOW_UPDATES:
+        failures.append("the users waited for the slow chat")
+    if result['all_slow_replies'] != SLOW_UPDATES:
+        failures.append(f"the slow chat got {result['all_slow_replies']} of {SLOW_UPDATES} replies")
+    if len(result['errors']) != 1:
+        failures.append(f"{len(result['errors'])} handler errors, expected 1 (the broken chat): {result['errors'][:3]}")
+    if result.get('failed', 1) != 1:
+        failures.append(f"webhook metrics count {result['failed']} failed updates, expected 1")
+    return failures
+
+def main(modes):
+    ok = True
+    for mode in modes:
+        failures = check_mode(mode)
+        print(f"{mode}: {'ok' if not failures else '; '.join(failures)}")
+        ok = ok and not failures
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--worker']:
+        run_worker(sys.argv[2])
+    else:
+        sys.exit(main(sys.argv[1:] or MODES))
@@ -0,0 +1,595 @@
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import json
+import logging
+import os
+import re
+import signal
+import time
+
+import httpx
+import tornado.web
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove, Update
+from telegram.ext import (
+    Application, BaseUpdateProcessor, CallbackQueryHandler, CommandHandler, ContextTypes,
+    ConversationHandler, MessageHandler, filters
+)
+
+from events_store import (
+    BLOB_CHUNK_SIZE, CONTACT_DATA_FILE, EVENT_DATA_FILE, REGISTRATION_DATA_FILE, USER_DATA_FILE,
+    BlobTooLarge, BlobWriter, add_user, cancel_registration, check_credentials, filter_events,
+    find_data, format_date, format_size, format_time, get_storage, get_user_id, load_data,
+    migrate_file_blobs, migrate_message_ids, next_id, record_upload, register_for_event,
+    registration_summary, send_contact_message, upgrade_tables, username_exists
+)
+
+logger = logging.getLogger(__name__)
+
+# Bot API endpoint; point TELEGRAM_BASE_URL at a local (or fake) Bot API server for testing,
+# e.g. http://127.0.0.1:8081/bot
+BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
+BOT_BASE_URL = os.environ.get('TELEGRAM_BASE_URL', 'https://api.telegram.org/bot')
+BOT_BASE_FILE_URL = os.environ.get('TELEGRAM_BASE_FILE_URL', 'https://api.telegram.org/file/bot')
+BOT_LOCAL_MODE = os.environ.get('TELEGRAM_LOCAL_MODE') == '1'
+
+# Updates handled at the same time, and threads that run the (blocking) storage calls for them
+BOT_CONCURRENT_UPDATES = int(os.environ.get('BOT_CONCURRENT_UPDATES', '64'))
+BOT_STORAGE_WORKERS = int(os.environ.get('BOT_STORAGE_WORKERS', '8'))
+# Largest document accepted (the cloud Bot API serves files up to 20 MB), and the download timeout
+BOT_MAX_UPLOAD_SIZE = int(os.environ.get('BOT_MAX_UPLOAD_SIZE', str(20 * 1024 * 1024)))
+BOT_DOWNLOAD_TIMEOUT = float(os.environ.get('BOT_DOWNLOAD_TIMEOUT', '60'))
+# 'polling' (default) or 'webhook'
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+
+# Webhook mode: Telegram POSTs updates to WEBHOOK_URL, which must reach WEBHOOK_PATH on this
+# process. WEBHOOK_WORKERS workers handle the accepted updates; once WEBHOOK_QUEUE_SIZE of them are
+# waiting or running, the endpoint answers 503 and Telegram delivers the update again later.
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', '1000'))
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', '32'))
+WEBHOOK_RETRY_AFTER = 1
+# GET /metrics is served on its own listener, local by default, not on the public webhook port
+WEBHOOK_METRICS_LISTEN = os.environ.get('WEBHOOK_METRICS_LISTEN', '127.0.0.1')
+WEBHOOK_METRICS_PORT = int(os.environ.get('WEBHOOK_METRICS_PORT', '9090'))
+
+BOT_EVENTS_LIMIT = 10
+BOT_MESSAGES_LIMIT = 10
+
+STORAGE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=BOT_STORAGE_WORKERS, thread_name_prefix='storage')
+
+# Run a storage function on the storage threads so the event loop keeps serving other updates
+async def run_storage(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(STORAGE_EXECUTOR, functools.partial(func, *args))
+
+# Handles updates from different chats concurrently, but each chat's updates one at a time and
+# in arrival order: the ConversationHandler assumes a chat's updates come one by one, otherwise
+# e.g. a password could be read while the chat is still in the username state. The first update
+# of an idle chat becomes the chat's consumer and also runs the updates that arrive for the chat
+# in the meantime; those are only queued and return at once, so an update waiting for its
+# chat's turn never holds one of the max_concurrent_updates slots (or a webhook worker).
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        # chat ID -> updates waiting for the chat's consumer
+        self.chat_queues = {}
+
+    async def do_process_update(self, update, coroutine):
+        key = update_chat_key(update)
+        if key is None:
+            await coroutine
+            return
+        if key in self.chat_queues:
+            self.chat_queues[key].append(coroutine)
+            return
+        queue = self.chat_queues[key] = collections.deque([coroutine])
+        try:
+            while queue:
+                coroutine = queue.popleft()
+                try:
+                    await coroutine
+                except Exception:
+                    logger.exception("Error while handling an update")
+        finally:
+            del self.chat_queues[key]
+            # Only left over when cancelled (shutdown): drop the updates that never started
+            for coroutine in queue:
+                coroutine.close()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+def update_chat_key(update):
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return None
+
+# States for ConversationHandler
+(
+    START, LOGIN_USERNAME, LOGIN_PASSWORD, SIGN_UP_NAME, SIGN_UP_LAST_NAME, SIGN_UP_MOBILE,
+    SIGN_UP_USERNAME, SIGN_UP_PASSWORD, MENU, CONTACT_SUBJECT, CONTACT_MESSAGE, FILE_EXCHANGE
+) = range(12)
+
+START_KEYBOARD = ReplyKeyboardMarkup([["Login", "Sign Up"]], resize_keyboard=True, one_time_keyboard=True)
+MENU_EVENTS = "📅 Events"
+MENU_REGISTRATIONS = "🗂️ My Registrations"
+MENU_MESSAGES = "✉️ Messages"
+MENU_CONTACT = "📧 Contact Admin"
+MENU_FILE = "📂 Send File"
+MENU_LOGOUT = "🚪 Logout"
+MENU_KEYBOARD = ReplyKeyboardMarkup(
+    [[MENU_EVENTS, MENU_REGISTRATIONS], [MENU_MESSAGES, MENU_CONTACT], [MENU_FILE, MENU_LOGOUT]],
+    resize_keyboard=True
+)
+
+def menu_option(label):
+    return filters.Regex(f'^{re.escape(label)}$')
+
+def text_input():
+    return filters.TEXT & ~filters.COMMAND
+
+# Create tables/columns and run one-shot migrations before the first update is handled
+async def warm_up(application: Application) -> None:
+    await run_storage(get_storage)
+    await run_storage(upgrade_tables)
+    await run_storage(migrate_file_blobs)
+    await run_storage(migrate_message_ids)
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    if context.user_data.get('user_id') is not None:
+        return await show_menu(update, context, "Welcome back!")
+    await update.message.reply_text('Welcome! Please choose an option:', reply_markup=START_KEYBOARD)
+    return START
+
+async def show_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, text="Please choose an option:") -> int:
+    await update.effective_message.reply_text(text, reply_markup=MENU_KEYBOARD)
+    return MENU
+
+# Login
+async def login(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    await update.message.reply_text("Please enter your username:", reply_markup=ReplyKeyboardRemove())
+    return LOGIN_USERNAME
+
+async def handle_login_username(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    context.user_data['login_username'] = update.message.text.strip()
+    await update.message.reply_text("Please enter your password:")
+    return LOGIN_PASSWORD
+
+async def handle_login_password(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    username = context.user_data.pop('login_username', '')
+    if await run_storage(check_credentials, username, update.message.text):
+        context.user_data['user_id'] = await run_storage(get_user_id, username)
+        context.user_data['username'] = username
+        return await show_menu(update, context, f"Welcome, {username}!")
+    await update.message.reply_text("Invalid credentials. Please enter your username:")
+    return LOGIN_USERNAME
+
+# Sign up
+async def sign_up(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    context.user_data['sign_up'] = {}
+    await update.message.reply_text("Please enter your name:", reply_markup=ReplyKeyboardRemove())
+    return SIGN_UP_NAME
+
+async def handle_sign_up_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    context.user_data['sign_up']['Name'] = update.message.text.strip()
+    await update.message.reply_text("Please enter your last name:")
+    return SIGN_UP_LAST_NAME
+
+async def handle_sign_up_last_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    context.user_data['sign_up']['Last Name'] = update.message.text.strip()
+    await update.message.reply_text("Please enter your mobile number, or /skip:")
+    return SIGN_UP_MOBILE
+
+async def handle_sign_up_mobile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    mobile_number = update.message.text.replace(",", "").strip()
+    context.user_data['sign_up']['Mobile Number'] = None if mobile_number == '/skip' else mobile_number
+    await update.message.reply_text("Please choose a username:")
+    return SIGN_UP_USERNAME
+
+async def handle_sign_up_username(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    username = update.message.text.strip()
+    if await run_storage(username_exists, username):
+        await update.message.reply_text("Username already exists. Please choose a different username.")
+        return SIGN_UP_USERNAME
+    context.user_data['sign_up']['Username'] = username
+    await update.message.reply_text("Please choose a password:")
+    return SIGN_UP_PASSWORD
+
+async def handle_sign_up_password(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    user_data = context.user_data.pop('sign_up')
+    user_data['Password'] = update.message.text
+    # The Telegram account the user signs up from
+    telegram_user = update.effective_user
+    user_data['Telegram ID'] = telegram_user.username or str(telegram_user.id)
+    user_data['ID'] = str(await run_storage(next_id, USER_DATA_FILE))
+    if not await run_storage(add_user, user_data):
+        await update.message.reply_text("Username already exists. Please start again with /start.")
+        return ConversationHandler.END
+    await update.message.reply_text("User registered successfully! You can now log in.", reply_markup=START_KEYBOARD)
+    return START
+
+# Upcoming events with the user's status and the counts for each, in one storage call
+def event_listing(user_id):
+    events = filter_events(load_data(EVENT_DATA_FILE), 'Upcoming').head(BOT_EVENTS_LIMIT)
+    registrations = load_data(REGISTRATION_DATA_FILE, ['UserID', 'EventID', 'Status'])
+    registrations = registrations[registrations['EventID'].isin(events['EventID'])]
+    counts, user_status = registration_summary(registrations, user_id)
+    return events, counts, user_status
+
+def describe_event(event):
+    return (
+        f"{event['Event Name']}\n"
+        f"Date: {format_date(event['Date'])} ({event['Day']}) at {format_time(event['Time'])}\n"
+        f"Location: {event['Location']}\n"
+        f"{event['Description']}"
+    )
+
+async def show_events(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    events, counts, user_status = await run_storage(event_listing, context.user_data['user_id'])
+    if events.empty:
+        await update.message.reply_text("There are no upcoming events.")
+        return MENU
+    for _, event in events.iterrows():
+        event_id = event['EventID']
+        status = user_status.get(event_id)
+        keyboard = None
+        if status == 'Registered':
+            text = describe_event(event) + "\n\nYou are registered for this event."
+        elif status == 'Reserve':
+            text = describe_event(event) + "\n\nYou are on the reserve list for this event."
+        elif counts.get((event_id, 'Registered'), 0) < event['Max Volunteers']:
+            text = describe_event(event)
+            keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("Register", callback_data=f"register:{event_id}")]])
+        elif counts.get((event_id, 'Reserve'), 0) < event['Reserve Capacity']:
+            text = describe_event(event)
+            keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("Join Reserve List", callback_data=f"register:{event_id}")]])
+        else:
+            text = describe_event(event) + "\n\nEvent is full."
+        await update.message.reply_text(text, reply_markup=keyboard)
+    return MENU
+
+async def handle_register(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    user_id = context.user_data.get('user_id')
+    if user_id is None:
+        await query.answer("Please log in with /start first.", show_alert=True)
+        return
+    event_id = int(query.data.split(':')[1])
+    status = await run_storage(register_for_event, user_id, event_id)
+    if status == 'Missing':
+        await query.answer("This event is no longer available.", show_alert=True)
+        return
+    replies = {
+        'Registered': "Registered successfully!",
+        'Reserve': "Added to reserve list!",
+        'Full': "Event is full.",
+    }
+    await query.answer(replies[status])
+    await query.edit_message_text(f"{query.message.text}\n\n{replies[status]}")
+
+# The user's registrations with their events, in one storage call
+def registration_listing(user_id):
+    registrations = find_data(REGISTRATION_DATA_FILE, {'UserID': user_id})
+    events = load_data(EVENT_DATA_FILE)
+    return registrations.merge(events, on='EventID')
+
+async def show_registrations(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    registrations = await run_storage(registration_listing, context.user_data['user_id'])
+    if registrations.empty:
+        await update.message.reply_text("You have no registrations.")
+        return MENU
+    for _, registration in registrations.iterrows():
+        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("Cancel Registration", callback_data=f"cancel:{registration['EventID']}")]])
+        await update.message.reply_text(f"{describe_event(registration)}\n\nStatus: {registration['Status']}", reply_markup=keyboard)
+    return MENU
+
+async def handle_cancel_registration(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    user_id = context.user_data.get('user_id')
+    if user_id is None:
+        await query.answer("Please log in with /start first.", show_alert=True)
+        return
+    await run_storage(cancel_registration, user_id, int(query.data.split(':')[1]))
+    await query.answer("Registration canceled.")
+    await query.edit_message_text(f"{query.message.text}\n\nRegistration canceled.")
+
+async def show_messages(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    messages = await run_storage(find_data, CONTACT_DATA_FILE, {'UserID': context.user_data['user_id']})
+    if messages.empty:
+        await update.message.reply_text("No messages.")
+        return MENU
+    for _, message in messages.sort_values('MessageID').tail(BOT_MESSAGES_LIMIT).iterrows():
+        response = message['Response'] if message['Status'] == 'answered' else "(no response yet)"
+        await update.message.reply_text(f"Subject: {message['Subject']}\nMessage: {message['Message']}\nResponse: {response}")
+    return MENU
+
+# Contact admin
+async def contact_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    await update.message.reply_text("Please enter the subject of your message:", reply_markup=ReplyKeyboardRemove())
+    return CONTACT_SUBJECT
+
+async def handle_contact_subject(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    context.user_data['subject'] = update.message.text
+    await update.message.reply_text("Please enter your message:")
+    return CONTACT_MESSAGE
+
+async def handle_contact_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    subject = context.user_data.pop('subject')
+    await run_storage(send_contact_message, context.user_data['user_id'], subject, update.message.text)
+    return await show_menu(update, context, "Message sent to admin!")
+
+# File exchange
+async def file_exchange(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    await update.message.reply_text("Please send the file you want to upload, or /cancel:", reply_markup=ReplyKeyboardRemove())
+    return FILE_EXCHANGE
+
+# Chunks of a Telegram file: read from disk with a local Bot API server, streamed over HTTP otherwise
+async def telegram_file_chunks(telegram_file):
+    if BOT_LOCAL_MODE:
+        with open(telegram_file.file_path, 'rb') as f:
+            while chunk := await run_storage(f.read, BLOB_CHUNK_SIZE):
+                yield chunk
+        return
+    async with httpx.AsyncClient(timeout=BOT_DOWNLOAD_TIMEOUT) as client:
+        async with client.stream('GET', telegram_file.file_path) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(BLOB_CHUNK_SIZE):
+                yield chunk
+
+# Async counterpart of store_blob: write chunks into the blob store as they arrive, so at most
+# one chunk of the file is in memory; returns (hash, size)
+async def store_blob_stream(chunks, max_size=None):
+    writer = await run_storage(BlobWriter, max_size)
+    try:
+        async with contextlib.aclosing(chunks):
+            async for chunk in chunks:
+                await run_storage(writer.write, chunk)
+        return await run_storage(writer.finish)
+    except BaseException:
+        writer.discard()
+        raise
+
+async def handle_file_upload(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    document = update.message.document
+    too_large = f"That file is too large; the limit is {format_size(BOT_MAX_UPLOAD_SIZE)}. Please send a smaller file:"
+    if document.file_size and document.file_size > BOT_MAX_UPLOAD_SIZE:
+        await update.message.reply_text(too_large)
+        return FILE_EXCHANGE
+    telegram_file = await document.get_file()
+    try:
+        file_hash, size = await store_blob_stream(telegram_file_chunks(telegram_file), BOT_MAX_UPLOAD_SIZE)
+    except BlobTooLarge:
+        await update.message.reply_text(too_large)
+        return FILE_EXCHANGE
+    await run_storage(record_upload, context.user_data['user_id'], document.file_name, file_hash, size, False)
+    return await show_menu(update, context, "File uploaded successfully!")
+
+async def logout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    context.user_data.clear()
+    await update.message.reply_text("Logged out.", reply_markup=START_KEYBOARD)
+    return START
+
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    if context.user_data.get('user_id') is not None:
+        return await show_menu(update, context, "Cancelled.")
+    await update.message.reply_text('Cancelled. Use /start to begin again.', reply_markup=ReplyKeyboardRemove())
+    return ConversationHandler.END
+
+async def handle_error(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.error("Error while handling an update", exc_info=context.error)
+    # The application catches handler errors, so webhook mode counts its failed updates here
+    metrics = context.bot_data.get('webhook_metrics')
+    if metrics is not None and update is not None:
+        metrics['failed'] += 1
+
+def build_application(token, base_url=BOT_BASE_URL, base_file_url=BOT_BASE_FILE_URL, local_mode=BOT_LOCAL_MODE):
+    application = (
+        Application.builder()
+        .token(token)
+        .base_url(base_url)
+        .base_file_url(base_file_url)
+        .local_mode(local_mode)
+        .concurrent_updates(ChatOrderedUpdateProcessor(BOT_CONCURRENT_UPDATES))
+        .post_init(warm_up)
+        .build()
+    )
+
+    conv_handler = ConversationHandler(
+        entry_points=[CommandHandler('start', start)],
+        states={
+            START: [
+                MessageHandler(filters.Regex('^Login$'), login),
+                MessageHandler(filters.Regex('^Sign Up$'), sign_up),
+            ],
+            LOGIN_USERNAME: [MessageHandler(text_input(), handle_login_username)],
+            LOGIN_PASSWORD: [MessageHandler(text_input(), handle_login_password)],
+            SIGN_UP_NAME: [MessageHandler(text_input(), handle_sign_up_name)],
+            SIGN_UP_LAST_NAME: [MessageHandler(text_input(), handle_sign_up_last_name)],
+            SIGN_UP_MOBILE: [MessageHandler(text_input() | filters.Regex('^/skip$'), handle_sign_up_mobile)],
+            SIGN_UP_USERNAME: [MessageHandler(text_input(), handle_sign_up_username)],
+            SIGN_UP_PASSWORD: [MessageHandler(text_input(), handle_sign_up_password)],
+            MENU: [
+                MessageHandler(menu_option(MENU_EVENTS), show_events),
+                MessageHandler(menu_option(MENU_REGISTRATIONS), show_registrations),
+                MessageHandler(menu_option(MENU_MESSAGES), show_messages),
+                MessageHandler(menu_option(MENU_CONTACT), contact_admin),
+                MessageHandler(menu_option(MENU_FILE), file_exchange),
+                MessageHandler(menu_option(MENU_LOGOUT), logout),
+            ],
+            CONTACT_SUBJECT: [MessageHandler(text_input(), handle_contact_subject)],
+            CONTACT_MESSAGE: [MessageHandler(text_input(), handle_contact_message)],
+            FILE_EXCHANGE: [MessageHandler(filters.Document.ALL, handle_file_upload)],
+        },
+        fallbacks=[CommandHandler('cancel', cancel), CommandHandler('start', start)],
+        allow_reentry=True,
+    )
+
+    application.add_handler(conv_handler)
+    # Inline buttons under event and registration messages work from any conversation state
+    application.add_handler(CallbackQueryHandler(handle_register, pattern=r'^register:\d+$'))
+    application.add_handler(CallbackQueryHandler(handle_cancel_registration, pattern=r'^cancel:\d+$'))
+    application.add_error_handler(handle_error)
+    return application
+
+# Webhook mode
+def new_webhook_metrics(queue):
+    return {
+        'queue': queue,
+        # Accepted updates not handled yet: queued for a worker, waiting for their chat's turn or running
+        'pending': 0,
+        'busy_workers': 0,
+        'received': 0,
+        'rejected': 0,
+        'processed': 0,
+        'failed': 0,
+        'max_queue_depth': 0,
+        'last_latency': 0.0,
+        'total_latency': 0.0,
+    }
+
+def metrics_snapshot(metrics):
+    done = metrics['processed']
+    return {
+        'queue_depth': metrics['pending'] - metrics['busy_workers'],
+        'queue_capacity': WEBHOOK_QUEUE_SIZE,
+        'workers': WEBHOOK_WORKERS,
+        'busy_workers': metrics['busy_workers'],
+        'received': metrics['received'],
+        'rejected': metrics['rejected'],
+        'processed': metrics['processed'],
+        'failed': metrics['failed'],
+        'max_queue_depth': metrics['max_queue_depth'],
+        # Seconds from arrival at the endpoint to the end of handling
+        'last_latency': round(metrics['last_latency'], 4),
+        'average_latency': round(metrics['total_latency'] / done, 4) if done else 0.0,
+    }
+
+class WebhookHandler(tornado.web.RequestHandler):
+    def initialize(self, bot_application, metrics):
+        self.bot_application = bot_application
+        self.metrics = metrics
+
+    def post(self):
+        if WEBHOOK_SECRET and self.request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+            self.set_status(403)
+            return
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.bot_application.bot)
+        except ValueError:
+            self.set_status(400)
+            return
+        self.metrics['received'] += 1
+        if self.metrics['pending'] >= WEBHOOK_QUEUE_SIZE:
+            # Backpressure: Telegram retries updates that were not accepted
+            self.metrics['rejected'] += 1
+            self.set_status(503)
+            self.set_header('Retry-After', str(WEBHOOK_RETRY_AFTER))
+            return
+        self.metrics['pending'] += 1
+        self.metrics['queue'].put_nowait((time.monotonic(), update))
+        queue_depth = self.metrics['pending'] - self.metrics['busy_workers']
+        self.metrics['max_queue_depth'] = max(self.metrics['max_queue_depth'], queue_depth)
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def initialize(self, metrics):
+        self.metrics = metrics
+
+    def get(self):
+        self.write(metrics_snapshot(self.metrics))
+
+# One webhook update, run by the update processor in its chat's turn. Handler errors are counted
+# as failed by handle_error; processed counts every handled update, failed or not
+async def handle_webhook_update(application, metrics, received_at, update):
+    metrics['busy_workers'] += 1
+    try:
+        await application.process_update(update)
+    except Exception:
+        metrics['failed'] += 1
+        logger.exception("Error while handling a webhook update")
+    finally:
+        metrics['busy_workers'] -= 1
+        metrics['pending'] -= 1
+        metrics['processed'] += 1
+        metrics['last_latency'] = time.monotonic() - received_at
+        metrics['total_latency'] += metrics['last_latency']
+
+async def webhook_worker(application, metrics):
+    queue = metrics['queue']
+    while True:
+        received_at, update = await queue.get()
+        try:
+            # Through the update processor, so each chat's updates run one at a time, in order. If the
+            # chat is busy this only queues the update behind it and the worker moves on
+            await application.update_processor.process_update(update, handle_webhook_update(application, metrics, received_at, update))
+        finally:
+            queue.task_done()
+
+def make_webhook_app(application, metrics):
+    return tornado.web.Application([(WEBHOOK_PATH, WebhookHandler, {'bot_application': application, 'metrics': metrics})])
+
+def make_metrics_app(metrics):
+    return tornado.web.Application([('/metrics', MetricsHandler, {'metrics': metrics})])
+
+async def run_webhook(application, stop_event=None):
+    stop_event = stop_event or asyncio.Event()
+    # Bounded by the pending count (WEBHOOK_QUEUE_SIZE), which also covers updates that already
+    # left this queue to wait for their chat's turn
+    metrics = new_webhook_metrics(asyncio.Queue())
+    application.bot_data['webhook_metrics'] = metrics
+    await application.initialize()
+    # run_polling/run_webhook call post_init (warm_up); starting the application by hand does not
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    server = make_webhook_app(application, metrics).listen(WEBHOOK_PORT, address=WEBHOOK_LISTEN)
+    metrics_server = make_metrics_app(metrics).listen(WEBHOOK_METRICS_PORT, address=WEBHOOK_METRICS_LISTEN)
+    workers = [asyncio.create_task(webhook_worker(application, metrics)) for _ in range(WEBHOOK_WORKERS)]
+    try:
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                WEBHOOK_URL, secret_token=WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES,
+                max_connections=min(100, WEBHOOK_WORKERS)
+            )
+        logger.info("Webhook listening on %s:%s%s", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH)
+        await stop_event.wait()
+    finally:
+        server.stop()
+        metrics_server.stop()
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        await application.stop()
+        await application.shutdown()
+
+def main():
+    logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s %(message)s', level=logging.INFO)
+    if not BOT_TOKEN:
+        raise SystemExit("Set TELEGRAM_BOT_TOKEN to the bot's token.")
+    application = build_application(BOT_TOKEN)
+    if BOT_MODE != 'webhook':
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        return
+
+    async def serve():
+        stop_event = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            asyncio.get_running_loop().add_signal_handler(signum, stop_event.set)
+        await run_webhook(application, stop_event)
+    asyncio.run(serve())
+
+if __name__ == '__main__':
+    main()